@@ -5,6 +5,8 @@ import copy
 import sys
 sys.path.append('D:\\projects')
 import cognate.knowledge as cog
+import cognate.heuristic as heu
+import cognate.rule_compiler as rc
 
 
 class Functor(Enum):
@@ -18,6 +20,17 @@ class Functor(Enum):
     AT = 7
     TRIGGER = 8
 
+# Relations that never change while planning. KnowledgeStack keeps them out of its layers.
+STATIC_FUNCTORS = {
+    Functor.PATH,
+    Functor.DROP,
+    Functor.TELEPORTABLE,
+    Functor.DOWNSTAIRS,
+    Functor.UPSTAIRS,
+    Functor.TRIGGER,
+}
+
+
 class Path(cog.Fact):
     def __init__(self, node1, node2):
         self.functor = Functor.PATH
@@ -91,6 +104,46 @@ class Trigger(cog.Fact):
         return f"Trigger {self.arguments}" 
 
 
+def _compile_rules():
+    agent = cog.Variable()
+    location = cog.Variable()
+    current_location = cog.Variable()
+    gate1 = cog.Variable()
+    gate2 = cog.Variable()
+
+    # Wherever the agent is, with a path from there to location.
+    # With relaxed planning we may have simultaneous open/closed gates.
+    # If a gate is both open and closed, we allow passage.
+    can_move = rc.CompiledRule([
+        (Functor.AT, (agent, current_location)),
+        (Functor.PATH, (current_location, location)),
+        rc.AnyOf(
+            [(Functor.OPEN_GATE, (current_location, location))],
+            [rc.Not(Functor.CLOSED_GATE, (current_location, location))]
+        )
+    ], parameters=(agent, location))
+
+    # a trigger wherever the agent is, with the gates it controls
+    can_trigger = rc.CompiledRule([
+        (Functor.AT, (agent, location)),
+        (Functor.TRIGGER, (gate1, gate2, location))
+    ], parameters=(agent,))
+    return can_move, can_trigger
+
+CAN_MOVE_RULE, CAN_TRIGGER_RULE = _compile_rules()
+# which AnyOf alternative let a move through
+THROUGH_OPEN_GATE = 0
+
+# Rules keep asking the same thing of unchanged knowledge, within a relaxed planning graph
+# layer and from one sibling state to the next. Their answers are kept until a functor
+# they read changes.
+RULE_MEMO = cog.VersionedMemo()
+
+# what a bandit's moves and triggers depend on
+ACTION_FUNCTORS = (Functor.AT, Functor.PATH, Functor.TRIGGER, Functor.OPEN_GATE, Functor.CLOSED_GATE)
+GATE_FUNCTORS = (Functor.OPEN_GATE, Functor.CLOSED_GATE)
+
+
 class CanMoveRule:
     def __init__(self, agent, location):
         self.agent = agent
@@ -98,38 +151,30 @@ class CanMoveRule:
         self.current_location = []
         self.dependencies = set()
 
+        self.rule = RULE_MEMO.bind(('can_move', agent, location), CAN_MOVE_RULE.functors,
+                                   CAN_MOVE_RULE.bind(agent, location))
+
     def test(self, knowledge: cog.KnowledgeStack) -> bool:
         """
         Must be a path, no closed gate
         """
-        current_location = cog.Variable()
-        knowledge.find_possible_solutions( cog.Proposal( Functor.AT, (self.agent, current_location) ) )
+        # results describe the latest test only, the same rule may be tested in many states
+        self.current_location = []
+        self.dependencies = set()
 
-        # it's unlikely that there is no location, but...
-        if len(current_location.possible_values) == 0:
-            return False
-        
-        # On the other hand, with relaxed planning it's possible to be in many locations at once..
-        # see if there's a path from any of my locations
-        found = False
-        for current_location in current_location.possible_values:
-            if knowledge.check_fact(Path(current_location, self.location)):
-                
-                # With relaxed planning we may have simultaneous open/closed gates.
-                # If a gate is both open and closed, we allow passage.
-                if knowledge.check_fact(OpenGate(current_location, self.location)):
-                    self.dependencies.add(OpenGate(current_location, self.location))
-                elif knowledge.check_fact(ClosedGate(current_location, self.location)):
-                    continue
-                               
-                self.dependencies.add(At(self.agent, current_location))
-                self.dependencies.add(Path(current_location, self.location))
+        # With relaxed planning it's possible to be in many locations at once,
+        # each one with a path is a solution.
+        names = cog.SYMBOLS.names
+        for current_location, gate in self.rule(knowledge):
+            current_location = names[current_location]
+            if gate == THROUGH_OPEN_GATE:
+                self.dependencies.add(OpenGate(current_location, self.location))
+            self.dependencies.add(At(self.agent, current_location))
+            self.dependencies.add(Path(current_location, self.location))
 
-                self.current_location.append(current_location)
+            self.current_location.append(current_location)
 
-                found = True
-        
-        return found
+        return len(self.current_location) > 0
     
 
 class CanTriggerRule:
@@ -137,29 +182,20 @@ class CanTriggerRule:
         self.agent = agent
         self.dependencies = set()
 
+        self.rule = RULE_MEMO.bind(('can_trigger', agent), CAN_TRIGGER_RULE.functors,
+                                   CAN_TRIGGER_RULE.bind(agent))
+
     def test(self, knowledge: cog.KnowledgeStack) -> bool:
-        current_location = cog.Variable()
-        knowledge.find_possible_solutions( cog.Proposal( Functor.AT, (self.agent, current_location) ) )
+        self.dependencies = set()
 
-        # it's unlikely that there is no location, but...
-        if len(current_location.possible_values) == 0:
-            return False
-        
-        # On the other hand, with relaxed planning it's possible to be in many locations at once..
+        # with relaxed planning it's possible to be in many locations at once
+        names = cog.SYMBOLS.names
         found = False
-        for current_location in current_location.possible_values:
-            gate1 = cog.Variable()   
-            gate2 = cog.Variable() 
-            knowledge.find_possible_solutions( cog.Proposal( Functor.TRIGGER, (gate1, gate2, current_location) ) )
-            if len(gate1.possible_values) > 0:
-                found = True
-                self.dependencies.add(At(self.agent, current_location)) 
-       
-                # Not all combinations are actually real.
-                for g1 in gate1.possible_values:
-                    for g2 in gate2.possible_values:
-                        if knowledge.check_fact(Trigger(g1, g2, current_location)): 
-                            self.dependencies.add(Trigger(g1, g2, current_location)) 
+        for location, gate1, gate2 in self.rule(knowledge):
+            found = True
+            location = names[location]
+            self.dependencies.add(At(self.agent, location))
+            self.dependencies.add(Trigger(names[gate1], names[gate2], location))
        
         # trigger is at agent location
         return found
@@ -193,6 +229,7 @@ class MoveAction:
     
     def generate_delete_list(self, knowledge: cog.KnowledgeStack):
         # we sometimes have multiple prev_locations
+        self.delete_list = set()
         prevs = set(self.prev_location)
         for prev in prevs:
             self.delete_list.add(At(self.agent, prev))
@@ -228,24 +265,30 @@ class TriggerAction:
 
     def generate_add_list(self, knowledge: cog.KnowledgeStack):
         # flop gate pairs
+        self.add_list = set()
         for dep in self.can_trigger_rule.dependencies:
             if dep.functor == Functor.TRIGGER:
                 gate1, gate2, self.location = dep.arguments
-                if knowledge.check_fact(OpenGate(gate1, gate2)):
-                    self.add_list.add(ClosedGate(gate1, gate2))
-                if knowledge.check_fact(ClosedGate(gate1, gate2)):
-                    self.add_list.add(OpenGate(gate1, gate2))
+                open_gate = OpenGate(gate1, gate2)
+                closed_gate = ClosedGate(gate1, gate2)
+                if knowledge.check_fact(open_gate):
+                    self.add_list.add(closed_gate)
+                if knowledge.check_fact(closed_gate):
+                    self.add_list.add(open_gate)
         return self.add_list
     
     def generate_delete_list(self, knowledge: cog.KnowledgeStack):
         # flop gate pairs
+        self.delete_list = set()
         for dep in self.can_trigger_rule.dependencies:
             if dep.functor == Functor.TRIGGER:
                 gate1, gate2, _ = dep.arguments
-                if knowledge.check_fact(ClosedGate(gate1, gate2)):
-                    self.delete_list.add(ClosedGate(gate1, gate2))
-                if knowledge.check_fact(OpenGate(gate1, gate2)):
-                    self.delete_list.add(OpenGate(gate1, gate2))
+                open_gate = OpenGate(gate1, gate2)
+                closed_gate = ClosedGate(gate1, gate2)
+                if knowledge.check_fact(closed_gate):
+                    self.delete_list.add(closed_gate)
+                if knowledge.check_fact(open_gate):
+                    self.delete_list.add(open_gate)
         return self.delete_list
     
     def __repr__(self):
@@ -255,39 +298,373 @@ class TriggerAction:
         return hash((self.dependencies, self.add_list, self.add_list, 'trigger'))
 
 
+class GroundMove:
+    """ A move into a location from whichever of its neighbours the agent can leave right now.
+    Never changes once made: the template below hands out one per combination of usable 
+    neighbours and reuses it in every state where that combination comes up again.
+    """
+    __slots__ = ('template', 'key', 'agent', 'location', 'prev_location', 'dependencies', 
+                 'add_list', 'delete_list')
+
+    def __init__(self, template: 'MoveTemplate', key: Tuple):
+        self.template = template
+        self.key = key
+        self.agent = template.agent
+        self.location = template.location
+
+        prev_location = []
+        dependencies = set()
+        for usable, (node, at, path, open_gate, _) in zip(key, template.sources):
+            if usable == MoveTemplate.BLOCKED:
+                continue
+            prev_location.append(node)
+            dependencies.add(at)
+            dependencies.add(path)
+            if usable == MoveTemplate.THROUGH_GATE:
+                dependencies.add(open_gate)
+        self.prev_location = tuple(prev_location)
+        self.dependencies = frozenset(dependencies)
+        self.add_list = frozenset([At(self.agent, self.location)])
+        # we sometimes have multiple prev_locations
+        self.delete_list = frozenset(At(self.agent, prev) for prev in prev_location)
+
+    def meets_preconditions(self, knowledge: cog.KnowledgeStack) -> bool:
+        return self.template.usable(knowledge) == self.key
+
+    def generate_add_list(self, knowledge: cog.KnowledgeStack):
+        return self.add_list
+
+    def generate_delete_list(self, knowledge: cog.KnowledgeStack):
+        return self.delete_list
+
+    def __repr__(self):
+        return f"Move {self.agent} from {list(self.prev_location)} to {self.location}"
+
+
+class MoveTemplate:
+    """ Every way for one agent to move into one location, grounded once per world. """
+    # how each neighbour can be left for location
+    BLOCKED = 0
+    OPEN = 1
+    THROUGH_GATE = 2
+
+    __slots__ = ('agent', 'location', 'sources', 'variants')
+
+    def __init__(self, agent, location, sources: Tuple):
+        self.agent = agent
+        self.location = location
+        # per neighbour with a path here: (node, At, Path, OpenGate, ClosedGate) facts
+        self.sources = sources
+        # usable key -> GroundMove
+        self.variants = {}
+
+    def usable(self, knowledge: cog.KnowledgeStack) -> Tuple:
+        """ How each neighbour can be left for location in this state. Same rules as CanMoveRule. """
+        key = []
+        for node, at, path, open_gate, closed_gate in self.sources:
+            if not knowledge.check_fact(at):
+                key.append(MoveTemplate.BLOCKED)
+            # With relaxed planning we may have simultaneous open/closed gates.
+            # If a gate is both open and closed, we allow passage.
+            elif knowledge.check_fact(open_gate):
+                key.append(MoveTemplate.THROUGH_GATE)
+            elif knowledge.check_fact(closed_gate):
+                key.append(MoveTemplate.BLOCKED)
+            else:
+                key.append(MoveTemplate.OPEN)
+        return tuple(key)
+
+    def bind(self, knowledge: cog.KnowledgeStack) -> GroundMove:
+        """ The move as it can be made in this state, or None. """
+        key = self.usable(knowledge)
+        if not any(key):
+            return None
+        try:
+            return self.variants[key]
+        except KeyError:
+            variant = GroundMove(self, key)
+            self.variants[key] = variant
+            return variant
+
+    def __reduce__(self):
+        # the variants are rebuilt on demand on the other side
+        return (MoveTemplate, (self.agent, self.location, self.sources))
+
+
+class GroundTrigger:
+    """ Pulling the triggers at one location, with the gates they control in a given state. """
+    __slots__ = ('template', 'key', 'agent', 'location', 'dependencies', 'add_list', 'delete_list')
+
+    def __init__(self, template: 'TriggerTemplate', key: Tuple):
+        self.template = template
+        self.key = key
+        self.agent = template.agent
+        self.location = template.location
+        self.dependencies = template.dependencies
+
+        # flop gate pairs
+        add_list = set()
+        delete_list = set()
+        for state, (_, open_gate, closed_gate) in zip(key, template.gates):
+            if state & TriggerTemplate.OPEN:
+                add_list.add(closed_gate)
+                delete_list.add(open_gate)
+            if state & TriggerTemplate.CLOSED:
+                add_list.add(open_gate)
+                delete_list.add(closed_gate)
+        self.add_list = frozenset(add_list)
+        self.delete_list = frozenset(delete_list)
+
+    def meets_preconditions(self, knowledge: cog.KnowledgeStack) -> bool:
+        return self.template.gate_states(knowledge) == self.key
+
+    def generate_add_list(self, knowledge: cog.KnowledgeStack):
+        return self.add_list
+
+    def generate_delete_list(self, knowledge: cog.KnowledgeStack):
+        return self.delete_list
+
+    def __repr__(self):
+        return f"Trigger at {self.location}"
+
+
+class TriggerTemplate:
+    """ The triggers at one location for one agent, grounded once per world. """
+    # gate state bits
+    OPEN = 1
+    CLOSED = 2
+
+    __slots__ = ('agent', 'location', 'at', 'gates', 'dependencies', 'variants')
+
+    def __init__(self, agent, location, gates: Tuple):
+        self.agent = agent
+        self.location = location
+        self.at = At(agent, location)
+        # per trigger here: (Trigger, OpenGate, ClosedGate) facts
+        self.gates = gates
+        self.dependencies = frozenset([self.at] + [trigger for trigger, _, _ in gates])
+        # gate states -> GroundTrigger
+        self.variants = {}
+
+    def gate_states(self, knowledge: cog.KnowledgeStack) -> Tuple:
+        """ Whether each gate is open and/or closed, or None if the agent isn't here. """
+        if not knowledge.check_fact(self.at):
+            return None
+        return tuple((TriggerTemplate.OPEN if knowledge.check_fact(open_gate) else 0) |
+                     (TriggerTemplate.CLOSED if knowledge.check_fact(closed_gate) else 0)
+                     for _, open_gate, closed_gate in self.gates)
+
+    def bind(self, knowledge: cog.KnowledgeStack) -> GroundTrigger:
+        key = self.gate_states(knowledge)
+        if key is None:
+            return None
+        try:
+            return self.variants[key]
+        except KeyError:
+            variant = GroundTrigger(self, key)
+            self.variants[key] = variant
+            return variant
+
+    def __reduce__(self):
+        return (TriggerTemplate, (self.agent, self.location, self.gates))
+
+
+class GroundActions:
+    """ All of an agent's move and trigger templates for one world. """
+    def __init__(self, agent, knowledge: cog.KnowledgeStack):
+        def decoded(functor):
+            # sorted, so that actions come out in the same order in every process
+            return sorted(cog.SYMBOLS.decode(args) for args in knowledge.flatten(functor))
+
+        sources = {}
+        for node1, node2 in decoded(Functor.PATH):
+            sources.setdefault(node2, []).append(
+                (node1, At(agent, node1), Path(node1, node2), OpenGate(node1, node2), ClosedGate(node1, node2)))
+        # destination -> MoveTemplate, and node -> templates of the moves out of it
+        self.moves_to = {}
+        self.moves_from = {}
+        for location, location_sources in sources.items():
+            template = MoveTemplate(agent, location, tuple(location_sources))
+            self.moves_to[location] = template
+            for node, _, _, _, _ in location_sources:
+                self.moves_from.setdefault(node, []).append(template)
+
+        gates = {}
+        for gate1, gate2, location in decoded(Functor.TRIGGER):
+            gates.setdefault(location, []).append(
+                (Trigger(gate1, gate2, location), OpenGate(gate1, gate2), ClosedGate(gate1, gate2)))
+        # location -> TriggerTemplate
+        self.triggers = {location: TriggerTemplate(agent, location, tuple(location_gates))
+                         for location, location_gates in gates.items()}
+
+
 class Bandit():
     def __init__(self, name):
         self.name = name
         self.goal = None
 
+        # compiled task, and the static store and gated paths it was compiled from
+        self.task = None
+        self.task_world = None
+        self.task_gates = None
+        # gate versions of the last state the task was checked against
+        self.task_gate_versions = None
+
+        # ground actions, and the static store they were grounded in
+        self.ground = None
+        self.ground_world = None
+
+        # where the bandit is
+        self.location_query = cog.Query( (Functor.AT, (name, cog.Variable())) )
+
+        # answers that only change with the facts they read, see VersionedMemo
+        self.memo = cog.VersionedMemo()
+
     def set_goal(self, goal):
         self.goal = goal
 
-    def produce_valid_actions(self, knowledge: cog.KnowledgeStack):
-        valid_actions = []
-        current_location = cog.Variable()
-        knowledge.find_possible_solutions( cog.Proposal( Functor.AT, (self.name, current_location) ) )
-        if len(current_location.possible_values) == 0:
-            return [] # maybe bandit is dead?
-        
+    def compile_task(self, knowledge: cog.KnowledgeStack) -> heu.GroundTask:
+        """ Ground the bandit's moves and triggers for this world, for CountingRelaxedPlanningGraph.
+        The task depends on the static facts, and on which paths have a gate at all, open
+        or closed. Gates open and close while planning without changing that, so the task
+        is only rebuilt when the world changes or a gate appears or goes.
+        """
+        gate_versions = knowledge.versions_of(GATE_FUNCTORS)
+        if self.task is not None and self.task_world is knowledge.static:
+            if gate_versions == self.task_gate_versions:
+                return self.task
+            if self._gates(knowledge) == self.task_gates:
+                self.task_gate_versions = gate_versions
+                return self.task
+
+        def decoded(functor):
+            return [cog.SYMBOLS.decode(args) for args in knowledge.flatten(functor)]
+
+        triggers = decoded(Functor.TRIGGER)
+        gates = set(decoded(Functor.OPEN_GATE)) | set(decoded(Functor.CLOSED_GATE))
+        gates.update((gate1, gate2) for gate1, gate2, _ in triggers)
+
+        task = heu.GroundTask()
+        for node1, node2 in decoded(Functor.PATH):
+            preconditions = [At(self.name, node1)]
+            # gated paths need the gate open, other paths are always passable
+            if (node1, node2) in gates:
+                preconditions.append(OpenGate(node1, node2))
+            task.add_action(('move', node2), preconditions, [At(self.name, node2)])
+
+        # a trigger flips every gate it controls. Each flip is its own ground action,
+        # sharing the operator of the trigger so that they count once per layer.
+        for gate1, gate2, location in triggers:
+            task.add_action(('trigger', location), 
+                [At(self.name, location), ClosedGate(gate1, gate2)], [OpenGate(gate1, gate2)])
+            task.add_action(('trigger', location), 
+                [At(self.name, location), OpenGate(gate1, gate2)], [ClosedGate(gate1, gate2)])
+
+        self.task = task
+        self.task_world = knowledge.static
+        self.task_gates = self._gates(knowledge)
+        self.task_gate_versions = gate_versions
+        return task
+
+    def _gates(self, knowledge: cog.KnowledgeStack) -> Set[Tuple]:
+        """ Encoded paths with a gate in knowledge, whether it's open or closed. """
+        return knowledge.flatten(Functor.OPEN_GATE) | knowledge.flatten(Functor.CLOSED_GATE)
+
+    def ground_actions(self, knowledge: cog.KnowledgeStack) -> GroundActions:
+        """ Every move and trigger of the bandit, grounded once per world.
+        Like the task, they only depend on static facts.
+        """
+        if self.ground is None or self.ground_world is not knowledge.static:
+            self.ground = GroundActions(self.name, knowledge)
+            self.ground_world = knowledge.static
+        return self.ground
+
+    def locations(self, knowledge: cog.KnowledgeStack) -> List:
         # with relaxed planning, bandit may be in multiple locations at once
-        for current_location in current_location.possible_values:
-            destinations = cog.Variable()
-            knowledge.find_possible_solutions( cog.Proposal( Functor.PATH, (current_location, destinations) ) )
-            for destination in destinations.possible_values:
-                potential_action = MoveAction(self.name, destination)
-                if potential_action.meets_preconditions(knowledge):
-                    valid_actions.append(potential_action)
-
-        potential_action = TriggerAction(self.name)
-        if potential_action.meets_preconditions(knowledge):
-            valid_actions.append(potential_action)
+        return self.memo.get(knowledge, 'locations', self.location_query.functors, self._solve_locations)
 
-        return valid_actions
+    def _solve_locations(self, knowledge: cog.KnowledgeStack) -> List:
+        return [location for location, in self.location_query.solve(knowledge)]
 
+    def make_action(self, operator, knowledge: cog.KnowledgeStack):
+        """ Real action for an operator of the compiled task, as it applies in knowledge. """
+        ground = self.ground_actions(knowledge)
+        if operator[0] == 'move':
+            return ground.moves_to[operator[1]].bind(knowledge)
+        return ground.triggers[operator[1]].bind(knowledge)
 
+    def bind_all(self, knowledge: cog.KnowledgeStack, templates) -> List:
+        valid_actions = []
+        for template in templates:
+            action = template.bind(knowledge)
+            if action is not None:
+                valid_actions.append(action)
+        return valid_actions
 
-k = cog.KnowledgeStack()
+    def produce_valid_actions(self, knowledge: cog.KnowledgeStack):
+        # Search asks for a state's actions, then its relaxed planning graph asks again.
+        # Ground actions are immutable, only the list needs copying.
+        return list(self.memo.get(knowledge, 'valid_actions', ACTION_FUNCTORS, self._valid_actions))
+
+    def _valid_actions(self, knowledge: cog.KnowledgeStack):
+        ground = self.ground_actions(knowledge)
+        locations = self.locations(knowledge)
+
+        # a move template covers every way into its destination, only bind it once
+        templates = {}
+        for location in locations:
+            for template in ground.moves_from.get(location, ()):
+                templates[template.location] = template
+            if location in ground.triggers:
+                templates[('trigger', location)] = ground.triggers[location]
+        return self.bind_all(knowledge, templates.values())
+
+    def produce_triggered_actions(self, knowledge: cog.KnowledgeStack, new_facts: List):
+        """ The actions that new_facts may have made possible, for semi-naive RPG expansion.
+        Moves start from a location we just reached, or through a gate that just opened. 
+        Triggers flip whatever gates they find, so they are retested whenever 
+        our location or any gate changes.
+        """
+        ground = self.ground_actions(knowledge)
+        templates = {}
+        retest_triggers = False
+        for fact in new_facts:
+            if fact.functor == Functor.AT:
+                agent, location = fact.arguments
+                if agent != self.name:
+                    continue
+                retest_triggers = True
+                for template in ground.moves_from.get(location, ()):
+                    templates[template.location] = template
+            elif fact.functor == Functor.OPEN_GATE:
+                retest_triggers = True
+                gate1, gate2 = fact.arguments
+                if gate2 in ground.moves_to and knowledge.check_fact(At(self.name, gate1)):
+                    templates[gate2] = ground.moves_to[gate2]
+            elif fact.functor == Functor.CLOSED_GATE:
+                retest_triggers = True
+
+        if retest_triggers:
+            for location in self.locations(knowledge):
+                if location in ground.triggers:
+                    templates[('trigger', location)] = ground.triggers[location]
+        return self.bind_all(knowledge, templates.values())
+
+    def __getstate__(self) -> dict:
+        # The task, ground actions and memo are rebuilt on demand on the other side.
+        # They are tied to this process's stores anyway, and would make the bandit
+        # sent with every request to a worker many times bigger.
+        state = dict(self.__dict__)
+        state.update(task=None, task_world=None, task_gates=None, task_gate_versions=None, 
+                     ground=None, ground_world=None, memo=None)
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        self.memo = cog.VersionedMemo()
+
+
+k = cog.KnowledgeStack(STATIC_FUNCTORS)
 
 # maze initial conditions
 k.append( Path('start', 'junction') )
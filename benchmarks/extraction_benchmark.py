@@ -0,0 +1,80 @@
+import time
+import sys
+sys.path.append("D:\\projects\\")
+
+import cognate.knowledge as cog
+import cognate.bandits as band
+import cognate.heuristic as heu
+
+
+class ScanningRelaxedPlanningGraph(heu.RelaxedPlanningGraph):
+    """ The extraction we used to do: rescan every earlier layer for each precondition. """
+    def analyze_plan(self):
+        helpful_actions = [set() for _ in range(self.depth)]
+        preconditions = [set() for _ in range(self.depth+1)]
+        preconditions[self.depth].add(self.goal)
+
+        for layer in reversed(range(self.depth)):
+            for pc in preconditions[layer+1]:
+                found = False
+                for l in range(layer+1):
+                    for action in self.plan[l]:
+                        if pc in action.add_list:
+                            found = True
+                            helpful_actions[l].add(action)
+                            preconditions[l].update(action.dependencies)
+                            break
+                    if found:
+                        break
+            self.knowledge.pop_layer()
+
+        if self.depth == 0:
+            return 0, []
+        return sum(len(l) for l in helpful_actions), helpful_actions[0]
+
+
+def timed(rpg_class):
+    """ Subclass of rpg_class that records how long analyze_plan takes. """
+    class Timed(rpg_class):
+        def analyze_plan(self):
+            start = time.perf_counter()
+            result = super().analyze_plan()
+            self.extraction_time = time.perf_counter() - start
+            return result
+    return Timed
+
+
+def corridor_maze(length: int) -> cog.KnowledgeStack:
+    """ A corridor of length nodes with a dead end alcove off every node. """
+    k = cog.KnowledgeStack(band.STATIC_FUNCTORS)
+    for i in range(length):
+        k.append( band.Path(f"c{i}", f"c{i+1}") )
+        k.append( band.Path(f"c{i+1}", f"c{i}") )
+        k.append( band.Path(f"c{i}", f"alcove{i}") )
+        k.append( band.Path(f"alcove{i}", f"c{i}") )
+    k.append( band.At('bandit_A', 'c0') )
+    return k
+
+
+def benchmark_extraction(lengths=(10, 25, 50, 100), repeats=3):
+    b = band.Bandit('bandit_A')
+    for length in lengths:
+        b.set_goal(band.At('bandit_A', f"c{length}"))
+        k = corridor_maze(length)
+
+        results = {}
+        for label, rpg_class in (('scan', ScanningRelaxedPlanningGraph), ('index', heu.RelaxedPlanningGraph)):
+            best = None
+            for _ in range(repeats):
+                rpg = timed(rpg_class)(k.snapshot(), b)
+                heuristic, _ = rpg.generate_heuristic()
+                if best is None or rpg.extraction_time < best:
+                    best = rpg.extraction_time
+            results[label] = (heuristic, best)
+
+        (h_scan, t_scan), (h_index, t_index) = results['scan'], results['index']
+        print(f"depth {length:>4}: scan {t_scan*1000:8.2f} ms, index {t_index*1000:8.2f} ms, "
+              f"speedup {t_scan / t_index:6.1f}x, heuristic {h_scan} / {h_index}")
+
+
+if __name__ == "__main__" : benchmark_extraction()
@@ -0,0 +1,104 @@
+import copy
+import time
+import tracemalloc
+import sys
+sys.path.append("D:\\projects\\")
+
+import cognate.knowledge as cog
+import cognate.bandits as band
+import cognate.heuristic as heu
+import cognate.search as search
+
+
+class BuildingBandit(band.Bandit):
+    """ How actions used to be produced: a new MoveAction per destination and a new
+    TriggerAction, each with its own rule, every time.
+    """
+    def make_action(self, operator, knowledge):
+        if operator[0] == 'move':
+            action = band.MoveAction(self.name, operator[1])
+        else:
+            action = band.TriggerAction(self.name)
+        return action if action.meets_preconditions(knowledge) else None
+
+    def produce_valid_actions(self, knowledge):
+        valid_actions = []
+        current_location = cog.Variable()
+        knowledge.find_possible_solutions( cog.Proposal( band.Functor.AT, (self.name, current_location) ) )
+        for current_location in current_location.possible_values:
+            destinations = cog.Variable()
+            knowledge.find_possible_solutions( cog.Proposal( band.Functor.PATH, (current_location, destinations) ) )
+            for destination in destinations.possible_values:
+                potential_action = band.MoveAction(self.name, destination)
+                if potential_action.meets_preconditions(knowledge):
+                    valid_actions.append(potential_action)
+
+        potential_action = band.TriggerAction(self.name)
+        if potential_action.meets_preconditions(knowledge):
+            valid_actions.append(potential_action)
+        return valid_actions
+
+    def produce_triggered_actions(self, knowledge, new_facts):
+        # the old actions aren't worth splitting up, test them all
+        return self.produce_valid_actions(knowledge)
+
+
+def plan_states(knowledge, agent) -> list:
+    """ Knowledge of every state along the plan, in relaxed planning graph layers too. """
+    states = [knowledge.snapshot()]
+    for action in search.SearchPlan(knowledge, agent).plan():
+        knowledge = knowledge.snapshot()
+        action.meets_preconditions(knowledge)
+        adds = action.generate_add_list(knowledge)
+        deletes = action.generate_delete_list(knowledge)
+        knowledge.push_layer()
+        for add in adds:
+            knowledge.append(add)
+        for delete in deletes:
+            knowledge.remove(delete)
+        states.append(knowledge)
+    return states
+
+
+def measure(agent, states, repeats: int) -> tuple:
+    """ Time and transient allocation per produce_valid_actions call. """
+    agent.produce_valid_actions(states[0])
+
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for knowledge in states:
+            agent.produce_valid_actions(knowledge)
+    elapsed = (time.perf_counter() - start) / (repeats * len(states))
+
+    allocated = 0
+    tracemalloc.start()
+    for knowledge in states:
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        agent.produce_valid_actions(knowledge)
+        _, peak = tracemalloc.get_traced_memory()
+        allocated += peak - before
+    tracemalloc.stop()
+    return elapsed, allocated // len(states)
+
+
+def benchmark_ground_actions(repeats=200):
+    test_k = copy.deepcopy(band.k)
+    test_k.append( band.At('bandit_A', 'start') )
+
+    b = band.Bandit('bandit_A')
+    b.set_goal(band.At('bandit_A', 'end'))
+    states = plan_states(test_k, b)
+
+    for label, agent in (('building', BuildingBandit('bandit_A')), ('ground', band.Bandit('bandit_A'))):
+        agent.set_goal(b.goal)
+        elapsed, allocated = measure(agent, states, repeats)
+        start = time.perf_counter()
+        s = search.SearchPlan(test_k, agent, rpg=heu.RelaxedPlanningGraph)
+        plan = s.plan()
+        search_time = time.perf_counter() - start
+        print(f"{label:>8}: {elapsed*1e6:7.1f} us and {allocated:>6} bytes per produce_valid_actions, "
+              f"search {search_time*1000:7.1f} ms, {len(plan)} steps, {s.dc_count} states")
+
+
+if __name__ == "__main__" : benchmark_ground_actions()
@@ -0,0 +1,43 @@
+import copy
+import time
+import sys
+sys.path.append("D:\\projects\\")
+
+import cognate.bandits as band
+import cognate.heuristic as heu
+import cognate.search as search
+import cognate.instrumentation as instrumentation
+
+
+def time_plan(knowledge, agent, rpg, repeats: int) -> tuple:
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        plan, report = search.SearchPlan(knowledge, agent, rpg=rpg).plan_with_report()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, report
+
+
+def benchmark_instrumentation(repeats=10):
+    test_k = copy.deepcopy(band.k)
+    test_k.append( band.At('bandit_A', 'start') )
+    b = band.Bandit('bandit_A')
+    b.set_goal(band.At('bandit_A', 'end'))
+
+    for rpg in (heu.RelaxedPlanningGraph, heu.CountingRelaxedPlanningGraph):
+        t_off, _ = time_plan(test_k, b, rpg, repeats)
+        instrumentation.enable(timers=False)
+        t_counters, _ = time_plan(test_k, b, rpg, repeats)
+        instrumentation.enable(timers=True)
+        t_timers, report = time_plan(test_k, b, rpg, repeats)
+        instrumentation.disable()
+        t_after, _ = time_plan(test_k, b, rpg, repeats)
+
+        print(f"{rpg.__name__:>29}: off {t_off*1000:7.2f} ms, counters {t_counters*1000:7.2f} ms, "
+              f"timers {t_timers*1000:7.2f} ms, off again {t_after*1000:7.2f} ms")
+        print(report)
+
+
+if __name__ == "__main__" : benchmark_instrumentation()
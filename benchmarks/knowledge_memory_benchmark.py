@@ -0,0 +1,50 @@
+import copy
+import tracemalloc
+import sys
+sys.path.append("D:\\projects\\")
+
+import cognate.knowledge as cog
+import cognate.bandits as band
+import cognate.search as search
+
+
+def deepcopy_snapshot(self):
+    """ How search.State used to copy knowledge for every successor. """
+    return copy.deepcopy(self)
+
+
+def measure_search(goal):
+    b = band.Bandit('bandit_A')
+    b.set_goal(goal)
+
+    test_k = copy.deepcopy(band.k)
+    test_k.append( band.At('bandit_A', 'start') )
+
+    tracemalloc.start()
+    s = search.SearchPlan(test_k, b)
+    plan = s.plan()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # the initial state counts as expanded too
+    states = s.dc_count + 1
+    return len(plan), states, current, peak
+
+
+def benchmark_state_allocations():
+    goal = band.At('bandit_A', 'end')
+
+    snapshot = cog.KnowledgeStack.snapshot
+    cog.KnowledgeStack.snapshot = deepcopy_snapshot
+    try:
+        before = measure_search(goal)
+    finally:
+        cog.KnowledgeStack.snapshot = snapshot
+    after = measure_search(goal)
+
+    for label, (steps, states, current, peak) in (('deepcopy', before), ('snapshot', after)):
+        print(f"{label:>8}: {steps} steps, {states} states, "
+              f"{current // states} bytes retained per state, peak {peak // 1024} KiB")
+
+
+if __name__ == "__main__" : benchmark_state_allocations()
@@ -0,0 +1,61 @@
+import copy
+import time
+import sys
+sys.path.append("D:\\projects\\")
+
+import cognate.knowledge as cog
+import cognate.bandits as band
+import cognate.heuristic as heu
+import cognate.search as search
+
+
+def grid_maze(side: int) -> cog.KnowledgeStack:
+    """ A side x side grid of nodes with paths both ways between neighbours. """
+    k = cog.KnowledgeStack(band.STATIC_FUNCTORS)
+    for x in range(side):
+        for y in range(side):
+            if x + 1 < side:
+                k.append( band.Path(f"n{x}_{y}", f"n{x+1}_{y}") )
+                k.append( band.Path(f"n{x+1}_{y}", f"n{x}_{y}") )
+            if y + 1 < side:
+                k.append( band.Path(f"n{x}_{y}", f"n{x}_{y+1}") )
+                k.append( band.Path(f"n{x}_{y+1}", f"n{x}_{y}") )
+    k.append( band.At('bandit_A', 'n0_0') )
+    return k
+
+
+def time_plan(knowledge, agent, rpg, strategy, repeats: int) -> tuple:
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        s = search.SearchPlan(knowledge, agent, rpg=rpg, strategy=strategy)
+        plan = s.plan()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(plan), s.dc_count, best
+
+
+def benchmark_knowledge_modes(repeats=3):
+    b = band.Bandit('bandit_A')
+
+    hard = copy.deepcopy(band.k)
+    hard.append( band.At('bandit_A', 'start') )
+    worlds = [('bandits maze', hard, band.At('bandit_A', 'end'))]
+    # the rule based RPG takes tens of seconds per plan beyond 10x10
+    for side in (5, 10):
+        worlds.append((f"{side}x{side} grid", grid_maze(side), band.At('bandit_A', f"n{side-1}_{side-1}")))
+
+    for label, stack, goal in worlds:
+        b.set_goal(goal)
+        trail = stack.to_trail()
+        for rpg in (heu.RelaxedPlanningGraph, heu.CountingRelaxedPlanningGraph):
+            for strategy in (search.SearchPlan.EHC, search.SearchPlan.GBFS):
+                steps, states, t_stack = time_plan(stack, b, rpg, strategy, repeats)
+                _, _, t_trail = time_plan(trail, b, rpg, strategy, repeats)
+                print(f"{label:>12} {rpg.__name__:>29} {strategy:>4}: {steps} steps, {states:>5} states, "
+                      f"stack {t_stack*1000:8.2f} ms, trail {t_trail*1000:8.2f} ms, "
+                      f"speedup {t_stack / t_trail:5.2f}x")
+
+
+if __name__ == "__main__" : benchmark_knowledge_modes()
@@ -0,0 +1,93 @@
+import copy
+import time
+import sys
+sys.path.append("D:\\projects\\")
+
+import cognate.knowledge as cog
+import cognate.bandits as band
+import cognate.heuristic as heu
+import cognate.search as search
+
+
+class UnmemoizedBandit(band.Bandit):
+    """ Asks knowledge every time, as before answers were memoized. """
+    def locations(self, knowledge):
+        return self._solve_locations(knowledge)
+
+    def produce_valid_actions(self, knowledge):
+        return self._valid_actions(knowledge)
+
+
+def sibling_states(knowledge, agent) -> list:
+    """ Every successor of every state along the plan, as search generates them. """
+    states = []
+    for action in search.SearchPlan(knowledge, agent).plan():
+        for sibling in agent.produce_valid_actions(knowledge):
+            state = knowledge.snapshot()
+            state.push_layer()
+            for add in sibling.generate_add_list(state):
+                state.append(add)
+            for delete in sibling.generate_delete_list(state):
+                state.remove(delete)
+            states.append(state)
+        knowledge = knowledge.snapshot()
+        knowledge.push_layer()
+        for add in action.generate_add_list(knowledge):
+            knowledge.append(add)
+        for delete in action.generate_delete_list(knowledge):
+            knowledge.remove(delete)
+    return states
+
+
+def time_questions(states, rules, repeats: int) -> float:
+    """ Each rule tested twice per state, as a state's successors and its relaxed planning graph do. """
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for knowledge in states:
+            for rule in rules:
+                rule.test(knowledge)
+                rule.test(knowledge)
+    return (time.perf_counter() - start) / repeats
+
+
+def benchmark_memo(repeats=50):
+    test_k = copy.deepcopy(band.k)
+    test_k.append( band.At('bandit_A', 'start') )
+    b = band.Bandit('bandit_A')
+    b.set_goal(band.At('bandit_A', 'end'))
+    states = sibling_states(test_k, b)
+
+    destinations = sorted(set(cog.SYMBOLS.decode(args)[1] for args in test_k.flatten(band.Functor.PATH)))
+    rules = [band.CanMoveRule('bandit_A', location) for location in destinations]
+    rules.append(band.CanTriggerRule('bandit_A'))
+    unmemoized = []
+    for rule in rules:
+        bare = copy.copy(rule)
+        if isinstance(rule, band.CanMoveRule):
+            bare.rule = band.CAN_MOVE_RULE.bind(rule.agent, rule.location)
+        else:
+            bare.rule = band.CAN_TRIGGER_RULE.bind(rule.agent)
+        unmemoized.append(bare)
+
+    t_bare = time_questions(states, unmemoized, repeats)
+    band.RULE_MEMO.hits = band.RULE_MEMO.misses = 0
+    t_memo = time_questions(states, rules, repeats)
+    print(f"rules over {len(states)} sibling states: compiled {t_bare*1000:7.2f} ms, "
+          f"memoized {t_memo*1000:7.2f} ms, speedup {t_bare / t_memo:5.2f}x, "
+          f"hit rate {band.RULE_MEMO.hit_rate():.2f}")
+
+    for label, agent in (('unmemoized', UnmemoizedBandit('bandit_A')), ('memoized', band.Bandit('bandit_A'))):
+        agent.set_goal(b.goal)
+        for rpg in (heu.RelaxedPlanningGraph, heu.CountingRelaxedPlanningGraph):
+            best = None
+            for _ in range(5):
+                start = time.perf_counter()
+                s = search.SearchPlan(test_k, agent, rpg=rpg)
+                plan = s.plan()
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            print(f"{label:>10} {rpg.__name__:>29}: {len(plan)} steps, {s.dc_count} states, "
+                  f"{best*1000:7.2f} ms")
+
+
+if __name__ == "__main__" : benchmark_memo()
@@ -0,0 +1,86 @@
+import copy
+import timeit
+import sys
+sys.path.append("D:\\projects\\")
+
+import cognate.knowledge as cog
+import cognate.bandits as band
+
+
+class InterpretedCanMoveRule(band.CanMoveRule):
+    """ CanMoveRule solved by the generic Query engine, as before rules were compiled. """
+    def __init__(self, agent, location):
+        super().__init__(agent, location)
+        current_location = cog.Variable()
+        self.query = cog.Query(
+            (band.Functor.AT, (agent, current_location)),
+            (band.Functor.PATH, (current_location, location))
+        )
+
+    def test(self, knowledge):
+        self.current_location = []
+        self.dependencies = set()
+        for current_location, in self.query.solve(knowledge):
+            open_gate = band.OpenGate(current_location, self.location)
+            if knowledge.check_fact(open_gate):
+                self.dependencies.add(open_gate)
+            elif knowledge.check_fact(band.ClosedGate(current_location, self.location)):
+                continue
+            self.dependencies.add(band.At(self.agent, current_location))
+            self.dependencies.add(band.Path(current_location, self.location))
+            self.current_location.append(current_location)
+        return len(self.current_location) > 0
+
+
+class InterpretedCanTriggerRule(band.CanTriggerRule):
+    def __init__(self, agent):
+        super().__init__(agent)
+        location = cog.Variable()
+        self.query = cog.Query(
+            (band.Functor.AT, (agent, location)),
+            (band.Functor.TRIGGER, (cog.Variable(), cog.Variable(), location))
+        )
+
+    def test(self, knowledge):
+        self.dependencies = set()
+        found = False
+        for location, gate1, gate2 in self.query.solve(knowledge):
+            found = True
+            self.dependencies.add(band.At(self.agent, location))
+            self.dependencies.add(band.Trigger(gate1, gate2, location))
+        return found
+
+
+def relaxed_knowledge() -> cog.KnowledgeStack:
+    """ The bandit in a few places at once, as in a relaxed planning graph layer. """
+    k = copy.deepcopy(band.k)
+    k.append( band.At('bandit_A', 'junction') )
+    k.push_layer()
+    k.append( band.At('bandit_A', 'trigger_c') )
+    k.append( band.At('bandit_A', 'path_a') )
+    k.append( band.OpenGate('path_a', 'trigger_a') )
+    return k
+
+
+def benchmark_rules(number=20000):
+    k = relaxed_knowledge()
+    cases = (
+        ('move to path_c', InterpretedCanMoveRule('bandit_A', 'path_c'), band.CanMoveRule('bandit_A', 'path_c')),
+        ('move to trigger_a', InterpretedCanMoveRule('bandit_A', 'trigger_a'), band.CanMoveRule('bandit_A', 'trigger_a')),
+        ('move to end', InterpretedCanMoveRule('bandit_A', 'end'), band.CanMoveRule('bandit_A', 'end')),
+        ('trigger', InterpretedCanTriggerRule('bandit_A'), band.CanTriggerRule('bandit_A')),
+    )
+    for label, interpreted, compiled in cases:
+        # both must agree before their times mean anything
+        assert interpreted.test(k) == compiled.test(k)
+        assert interpreted.dependencies == compiled.dependencies
+
+        t_interpreted = timeit.timeit(lambda: interpreted.test(k), number=number) / number
+        t_compiled = timeit.timeit(lambda: compiled.test(k), number=number) / number
+        print(f"{label:>17}: interpreted {t_interpreted*1e6:6.2f} us, compiled {t_compiled*1e6:6.2f} us, "
+              f"speedup {t_interpreted / t_compiled:5.2f}x")
+
+    print(band.CAN_MOVE_RULE.source)
+
+
+if __name__ == "__main__" : benchmark_rules()
@@ -0,0 +1,96 @@
+import json
+import platform
+import time
+import tracemalloc
+import sys
+sys.path.append("D:\\projects\\")
+
+import cognate.heuristic as heu
+import cognate.search as search
+import cognate.mazes as mazes
+
+
+def run_search(maze, rpg, strategy: str, time_budget: float, trace_memory: bool=False) -> dict:
+    """ One plan on a fresh bandit, stopped once time_budget seconds are spent. """
+    if trace_memory:
+        tracemalloc.start()
+
+    start = time.perf_counter()
+    s = search.SearchPlan(maze.knowledge, maze.bandit(), rpg=rpg, strategy=strategy)
+    progress = None
+    # steps of a tenth of the budget, so a timeout isn't overrun by much
+    while time.perf_counter() - start < time_budget:
+        progress = s.step(max_time_us=int(time_budget * 100000))
+        if progress.finished:
+            break
+    elapsed = time.perf_counter() - start
+
+    peak = None
+    if trace_memory:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    status = progress.status if progress is not None and progress.finished else 'timeout'
+    return dict(
+        status=status,
+        plan_length=len(s.result) if s.result is not None else None,
+        wall_time=elapsed,
+        dc_count=s.dc_count,
+        expansions=s.expansions,
+        evaluations=s.evaluation_count,
+        fell_back=s.fell_back,
+        peak_memory=peak,
+    )
+
+
+def benchmark_scaling(sizes=(10, 100, 1000, 10000, 100000),
+                      rpgs=(heu.CountingRelaxedPlanningGraph, heu.RelaxedPlanningGraph),
+                      strategy=search.SearchPlan.EHC, time_budget: float=30.0, seed: int=0,
+                      output: str=None, **maze_options) -> dict:
+    """ SearchPlan on generated mazes of each size, as JSON written to output,
+    or printed if there is none. Each plan runs twice: timed, then again under
+    tracemalloc for its peak memory, which slows it too much to time it.
+    Plans still running after time_budget seconds are reported as a timeout,
+    with the work done until then. The budget is checked between expansions, and 
+    one can take longer than the whole budget in the largest mazes.
+    An rpg that timed out isn't run on larger mazes, those are reported as skipped.
+    """
+    results = []
+    timed_out = set()
+    for nodes in sizes:
+        start = time.perf_counter()
+        maze = mazes.generate_maze(nodes, seed=seed, **maze_options)
+        generate_time = time.perf_counter() - start
+
+        for rpg in rpgs:
+            result = dict(maze.describe(), rpg=rpg.__name__, strategy=strategy, generate_time=generate_time)
+            if rpg in timed_out:
+                result['status'] = 'skipped'
+                results.append(result)
+                continue
+            result.update(run_search(maze, rpg, strategy, time_budget))
+            result['peak_memory'] = run_search(maze, rpg, strategy, time_budget, trace_memory=True)['peak_memory']
+            results.append(result)
+            if result['status'] == 'timeout':
+                timed_out.add(rpg)
+            print(f"{nodes:>7} nodes {rpg.__name__:>29}: {result['status']:>7}, {result['plan_length']} steps, "
+                  f"{result['dc_count']:>6} states, {result['evaluations']:>6} evaluations, "
+                  f"{result['wall_time']:8.3f}s, peak {result['peak_memory'] / 2**20:8.1f} MiB", file=sys.stderr)
+
+    report = dict(
+        benchmark='scaling',
+        created=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        python=platform.python_version(),
+        platform=platform.platform(),
+        time_budget=time_budget,
+        results=results,
+    )
+    if output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__" : benchmark_scaling(output=sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,47 @@
+import pickle
+import time
+import sys
+sys.path.append("D:\\projects\\")
+
+import cognate.knowledge as cog
+import cognate.bandits as band
+import cognate.shared_knowledge as shared
+
+
+def grid_maze(side: int) -> cog.KnowledgeStack:
+    """ A side x side grid of nodes with paths both ways between neighbours. """
+    k = cog.KnowledgeStack(band.STATIC_FUNCTORS)
+    for x in range(side):
+        for y in range(side):
+            if x + 1 < side:
+                k.append( band.Path(f"n{x}_{y}", f"n{x+1}_{y}") )
+                k.append( band.Path(f"n{x+1}_{y}", f"n{x}_{y}") )
+            if y + 1 < side:
+                k.append( band.Path(f"n{x}_{y}", f"n{x}_{y+1}") )
+                k.append( band.Path(f"n{x}_{y+1}", f"n{x}_{y}") )
+    k.append( band.At('bandit_A', 'n0_0') )
+    return k
+
+
+def worker_startup(static) -> tuple:
+    """ What a worker pays to receive static: bytes over the pipe and time to load them. """
+    payload = pickle.dumps(static)
+    start = time.perf_counter()
+    loaded = pickle.loads(payload)
+    elapsed = time.perf_counter() - start
+    if isinstance(loaded, shared.SharedStaticKnowledge):
+        loaded.close()
+    return len(payload), elapsed
+
+
+def benchmark_static_startup(sides=(10, 30, 100, 300)):
+    for side in sides:
+        k = grid_maze(side)
+        pickled_size, pickled_time = worker_startup(k.static)
+        with shared.share_static(k) as store:
+            shared_size, shared_time = worker_startup(store)
+        print(f"{side*side:>6} nodes: pickled {pickled_size // 1024:>6} KiB in {pickled_time*1000:8.2f} ms, "
+              f"shared {shared_size:>4} bytes in {shared_time*1000:6.3f} ms")
+
+
+if __name__ == "__main__" : benchmark_static_startup()
@@ -1,19 +1,80 @@
 from typing import Tuple, List
 from functools import reduce
+from collections import OrderedDict
 
 # The heuristic value that says "don't go here"
 DEAD_END = 99999
 
+
+class HeuristicCache:
+    """ Remembers the heuristic and helpful actions of states already evaluated, keyed by
+    agent, goal, heuristic engine, world and the state's Zobrist hash. Agents replan from 
+    nearly the same states tick after tick, so one cache is meant to be handed to each of 
+    their SearchPlans. The least recently used entry is evicted once max_size is reached.
+    """
+    def __init__(self, max_size: int=4096):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(agent, rpg, static, state_hash: int) -> Tuple:
+        """ The state hash only covers fluents, so the static store stands for the world.
+        It is in the key itself, not its id, so it can't be freed and its id reused
+        while entries from it are cached. rpg is the engine class: engines may disagree
+        on helpful actions, and on heuristics too.
+        """
+        return (agent.name, agent.goal, rpg, static, state_hash)
+
+    def get(self, key: Tuple):
+        """ (heuristic, helpful actions) for key, or None on a miss. """
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Tuple, value: Tuple[int, List]) -> None:
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return self.hits / lookups
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return f"HeuristicCache {len(self.entries)}/{self.max_size} entries, {self.hits} hits, {self.misses} misses, {self.evictions} evictions"
+
 class RelaxedPlanningGraph:
     def __init__(self, knowledge, agent):
         self.knowledge = knowledge
         self.agent = agent
         self.goal = agent.goal
 
-        # list of lists: each element is a layer of actions that can be taken
+        # list of lists: each element is the layer of actions that first became possible there.
+        # Relaxed facts are never deleted, so actions from earlier layers remain possible.
         self.plan = []
         self.depth = 0
 
+        # achievers[fact] = (layer, action): the first action in the graph that adds the fact
+        # and the layer of actions it belongs to. The fact first holds in the layer after.
+        self.achievers = {}
+
     def is_satisfied(self):
         # TODO We currently think of the goal as a fixed fact.
         # Is that too limiting? If we need to open it up as a proposal, we can do that..
@@ -21,12 +82,21 @@ class RelaxedPlanningGraph:
     
     def generate_heuristic(self, max_depth=999) -> Tuple[int, List]:
         """ Explain RPG so future self doesn't forget... """
+        # Agents that can say which actions a set of new facts enables get semi-naive 
+        # expansion: after the first layer, only those actions are tested again.
+        # Everyone else re-derives all of their actions on every layer.
+        incremental = hasattr(self.agent, 'produce_triggered_actions')
+        new_facts = None
+
         # Add positive facts from valid actions until goal state is found
         while self.depth < max_depth:
             if self.is_satisfied():
                 break
 
-            valid_actions = self.agent.produce_valid_actions(self.knowledge)
+            if incremental and new_facts is not None:
+                valid_actions = self.agent.produce_triggered_actions(self.knowledge, new_facts)
+            else:
+                valid_actions = self.agent.produce_valid_actions(self.knowledge)
 
             # if there are no actions and we haven't satisfied goals, this is a dead end
             if len(valid_actions) == 0:
@@ -38,13 +108,18 @@ class RelaxedPlanningGraph:
             # add a new fact layer populated by add effects from viable actions 
             # that aren't already in the knowledge stack
             self.knowledge.push_layer() 
+            new_facts = []
             for action in valid_actions:
                 adds = action.generate_add_list(self.knowledge) 
                 for add in adds:
-                    self.knowledge.append(add)
+                    # facts already true, from the start or an earlier layer, keep
+                    # their achiever, or have none
+                    if self.knowledge.append(add):
+                        new_facts.append(add)
+                        self.achievers[add] = (self.depth, action)
 
             # if no new facts were added, we have reached a terminal state
-            if self.knowledge.facts_in_current_add() == 0:
+            if len(new_facts) == 0:
                 return (DEAD_END, [])
             
             # increase depth and continue searching
@@ -72,16 +147,15 @@ class RelaxedPlanningGraph:
             # it's layer
              
             for pc in preconditions[layer+1]:
-                found = False
-                for l in range(layer+1):
-                    for action in self.plan[l]:
-                        if pc in action.add_list:
-                            found = True
-                            helpful_actions[l].add(action)
-                            preconditions[l].update(action.dependencies)
-                            break
-                    if found:
-                        break 
+                # facts that were true from the start have no achiever
+                try:
+                    l, action = self.achievers[pc]
+                except KeyError:
+                    continue
+                if l > layer:
+                    continue
+                helpful_actions[l].add(action)
+                preconditions[l].update(action.dependencies)
 
             self.knowledge.pop_layer()
 
@@ -92,14 +166,149 @@ class RelaxedPlanningGraph:
         # Fewer is better
         heuristic = reduce(lambda count, l: count + len(l), helpful_actions, 0)
 
-        # the last helpful actions in the stack indicate the agent's best moves
-        return heuristic, helpful_actions[0]
+        # the last helpful actions in the stack indicate the agent's best moves.
+        # The set is ordered by object id, list them in the order the agent produced them
+        # so that search breaks ties the same way every run.
+        helpful = helpful_actions[0]
+        return heuristic, [action for action in self.plan[0] if action in helpful]
 
-                 
-            
-                      
 
-                    
+class GroundAction:
+    """ An action of a compiled task, reduced to integer fact ids. 
+    operator is whatever the agent needs to turn it back into a real action.
+    """
+    def __init__(self, operator, preconditions: Tuple[int], adds: Tuple[int]):
+        self.operator = operator
+        self.preconditions = preconditions
+        self.adds = adds
+
+
+class GroundTask:
+    """ A domain compiled once per world into integer facts and ground actions.
+    Static facts are folded in by the compiler: they decide which ground actions exist
+    and never show up as facts here. Agents build these in compile_task().
+    """
+    def __init__(self):
+        self.facts = []     # facts[id] = Fact
+        self.fact_ids = {}  # dict[Fact] = id
+
+        self.actions = []
+        # precondition_of[fact id] = indices of the actions that need that fact
+        self.precondition_of = []
+
+    def fact_id(self, fact) -> int:
+        try:
+            return self.fact_ids[fact]
+        except KeyError:
+            fact_id = len(self.facts)
+            self.fact_ids[fact] = fact_id
+            self.facts.append(fact)
+            self.precondition_of.append([])
+            return fact_id
+
+    def add_action(self, operator, preconditions: List, adds: List) -> GroundAction:
+        action = GroundAction(
+            operator, 
+            tuple(set(self.fact_id(fact) for fact in preconditions)),
+            tuple(set(self.fact_id(fact) for fact in adds))
+        )
+        for fact_id in action.preconditions:
+            self.precondition_of[fact_id].append(len(self.actions))
+        self.actions.append(action)
+        return action
+
+    def initial_facts(self, knowledge) -> List[int]:
+        return [fact_id for fact_id, fact in enumerate(self.facts) if knowledge.check_fact(fact)]
+
+
+class CountingRelaxedPlanningGraph:
+    """ Same heuristic as RelaxedPlanningGraph, computed over the agent's GroundTask.
+    Each ground action keeps a count of its unsatisfied preconditions. Facts reached in a
+    layer decrement the counters of the actions that need them, and an action whose 
+    counter hits zero fires in that layer. Nothing is pushed onto the knowledge stack and 
+    no rules are evaluated, so the cost is linear in the size of the ground task.
+
+    The agent must provide compile_task(knowledge) and make_action(operator, knowledge),
+    which returns the action for an operator as it applies in knowledge.
+    """
+    def __init__(self, knowledge, agent):
+        self.knowledge = knowledge
+        self.agent = agent
+        self.goal = agent.goal
+        self.task = agent.compile_task(knowledge)
+
+        self.depth = 0
+        # fact_layer[fact id] is the first layer the fact holds in, -1 if unreached
+        self.fact_layer = []
+        # achiever[fact id] is the first ground action to add the fact
+        self.achiever = []
+
+    def generate_heuristic(self, max_depth=999) -> Tuple[int, List]:
+        task = self.task
+        if self.knowledge.check_fact(self.goal):
+            return 0, []
+        if self.goal not in task.fact_ids:
+            return (DEAD_END, [])
+        goal = task.fact_ids[self.goal]
+
+        counters = [len(action.preconditions) for action in task.actions]
+        self.fact_layer = [-1] * len(task.facts)
+        self.achiever = [None] * len(task.facts)
+
+        new_facts = task.initial_facts(self.knowledge)
+        for fact_id in new_facts:
+            self.fact_layer[fact_id] = 0
+        # actions without preconditions fire in the first layer
+        fired = [index for index, count in enumerate(counters) if count == 0]
+
+        while self.depth < max_depth:
+            for fact_id in new_facts:
+                for index in task.precondition_of[fact_id]:
+                    counters[index] -= 1
+                    if counters[index] == 0:
+                        fired.append(index)
+
+            # the next fact layer is whatever the fired actions add for the first time
+            self.depth += 1
+            new_facts = []
+            for index in fired:
+                action = task.actions[index]
+                for fact_id in action.adds:
+                    if self.fact_layer[fact_id] < 0:
+                        self.fact_layer[fact_id] = self.depth
+                        self.achiever[fact_id] = action
+                        new_facts.append(fact_id)
+            fired = []
+
+            if self.fact_layer[goal] >= 0:
+                return self.extract_plan(goal)
+
+            # nothing new, we have reached a terminal state
+            if len(new_facts) == 0:
+                return (DEAD_END, [])
+
+        return (DEAD_END, [])
 
+    def extract_plan(self, goal: int) -> Tuple[int, List]:
+        """ Walk back from the goal through the achievers, counting the operators used in each layer. """
+        goals = [set() for _ in range(self.depth+1)]
+        goals[self.depth].add(goal)
+        # dicts rather than sets, their order doesn't change with string hashing
+        operators = [{} for _ in range(self.depth)]
 
+        for layer in reversed(range(1, self.depth+1)):
+            for fact_id in goals[layer]:
+                action = self.achiever[fact_id]
+                operators[layer-1][action.operator] = None
+                for precondition in action.preconditions:
+                    precondition_layer = self.fact_layer[precondition]
+                    if precondition_layer > 0:
+                        goals[precondition_layer].add(precondition)
 
+        heuristic = reduce(lambda count, l: count + len(l), operators, 0)
+        helpful_actions = []
+        for operator in operators[0]:
+            action = self.agent.make_action(operator, self.knowledge)
+            if action is not None and action not in helpful_actions:
+                helpful_actions.append(action)
+        return heuristic, helpful_actions
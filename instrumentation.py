@@ -0,0 +1,160 @@
+from collections import Counter
+import functools
+import time
+
+import sys
+sys.path.append('D:\\projects')
+import cognate.knowledge as cog
+import cognate.heuristic as heu
+
+
+class Recorder:
+    """ Calls and time spent per instrumented method, keyed 'Class.method'.
+    Times are inclusive: check_fact's time also shows up in the flatten it calls.
+    """
+    def __init__(self):
+        self.counts = Counter()
+        # nanoseconds, only kept when timers are enabled
+        self.times = Counter()
+
+    def merge(self, other: 'Recorder') -> None:
+        self.counts.update(other.counts)
+        self.times.update(other.times)
+
+    def clear(self) -> None:
+        self.counts.clear()
+        self.times.clear()
+
+    def summary(self) -> list:
+        """ (name, calls, seconds) for each method called, slowest first. """
+        rows = [(name, count, self.times[name] / 1e9) for name, count in self.counts.items()]
+        return sorted(rows, key=lambda row: (-row[2], -row[1], row[0]))
+
+    def __repr__(self):
+        lines = [f"{name:>50}: {count:>9} calls {seconds*1000:10.3f} ms" for name, count, seconds in self.summary()]
+        return "\n".join(["Recorder"] + lines)
+
+
+# Where calls are counted. SearchPlan activates its own recorder while it steps,
+# so that interleaved plans each get their own numbers.
+GLOBAL = Recorder()
+_active = GLOBAL
+
+# (class, method name, what the class itself held before, or None if it inherited it)
+_patches = []
+_enabled = False
+_timers = False
+
+# The hot paths instrumented by enable()
+KNOWLEDGE_METHODS = ('flatten', 'check_fact', 'push_layer', 'pop_layer', 'append', 'remove')
+HEURISTIC_METHODS = ('generate_heuristic',)
+AGENT_METHODS = ('produce_valid_actions', 'produce_triggered_actions')
+
+
+def _counted(name: str, function):
+    @functools.wraps(function)
+    def counted(*args, **kwargs):
+        _active.counts[name] += 1
+        return function(*args, **kwargs)
+    counted.instrumented = True
+    return counted
+
+
+def _timed(name: str, function):
+    @functools.wraps(function)
+    def timed(*args, **kwargs):
+        recorder = _active
+        start = time.perf_counter_ns()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            recorder.times[name] += time.perf_counter_ns() - start
+            recorder.counts[name] += 1
+    timed.instrumented = True
+    return timed
+
+
+def instrument(cls, *names: str) -> None:
+    """ Count calls to cls's methods names, and time them if timers are on, until disable().
+    Methods cls doesn't have, or that are already instrumented, are skipped,
+    including those a subclass inherits from an instrumented base.
+    """
+    if not _enabled:
+        return
+    wrap = _timed if _timers else _counted
+    for name in names:
+        function = getattr(cls, name, None)
+        if function is None or getattr(function, 'instrumented', False):
+            continue
+        _patches.append((cls, name, cls.__dict__.get(name)))
+        setattr(cls, name, wrap(f"{cls.__name__}.{name}", function))
+
+
+def instrument_agent(agent) -> None:
+    """ The agent's action producers, whatever class it is. SearchPlan calls this. """
+    instrument(type(agent), *AGENT_METHODS)
+
+
+def enable(timers: bool=True) -> None:
+    """ Start counting calls on the planner's hot paths, and timing them with timers.
+    While disabled the methods are the originals, so instrumentation costs nothing.
+    Counting only costs a dict update per call, timers two clock reads more.
+    Calls in worker processes aren't seen.
+    """
+    global _enabled, _timers
+    if _enabled:
+        disable()
+    _enabled = True
+    _timers = timers
+    for cls in (cog.KnowledgeStack, cog.TrailKnowledge):
+        instrument(cls, *KNOWLEDGE_METHODS)
+    for cls in (heu.RelaxedPlanningGraph, heu.CountingRelaxedPlanningGraph):
+        instrument(cls, *HEURISTIC_METHODS)
+
+
+def disable() -> None:
+    """ Put the original methods back. Recorders keep what they counted. """
+    global _enabled
+    # newest first, in case a subclass was patched after its base
+    for cls, name, original in reversed(_patches):
+        if original is None:
+            delattr(cls, name)
+        else:
+            setattr(cls, name, original)
+    _patches.clear()
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def activate(recorder: Recorder) -> Recorder:
+    """ Count into recorder from now on. Returns the recorder it replaces. """
+    global _active
+    previous = _active
+    _active = recorder
+    return previous
+
+
+class recording:
+    """ Context manager that enables instrumentation and counts into a fresh recorder, eg
+        with instrumentation.recording() as recorder:
+            ...
+        print(recorder)
+    """
+    def __init__(self, timers: bool=True):
+        self.timers = timers
+        self.recorder = Recorder()
+
+    def __enter__(self) -> Recorder:
+        self.was_enabled = _enabled
+        if not _enabled:
+            enable(self.timers)
+        self.previous = activate(self.recorder)
+        return self.recorder
+
+    def __exit__(self, *exc) -> None:
+        activate(self.previous)
+        if not self.was_enabled:
+            disable()
@@ -1,6 +1,9 @@
+from collections import OrderedDict
 from enum import Enum
-from typing import List, Tuple, Set
+from typing import Callable, List, Tuple, Set
 import copy
+import random
+import weakref
 
 
 class Variable:
@@ -34,24 +37,143 @@ class Variable:
             return 'There are no solutions.'
 
 
-class Fact:
+class SymbolTable:
+    """ Maps the names used as fact arguments ('path_b1', 'bandit_A'...) to small integers.
+    Knowledge stores and compares the integer tuples; names only come back out at the
+    edges, in Variables and in the facts themselves.
+    """
+    def __init__(self):
+        self.codes = {} # dict[name] = int
+        self.names = [] # names[int] = name
+
+    def encode_symbol(self, name) -> int:
+        try:
+            return self.codes[name]
+        except KeyError:
+            code = len(self.names)
+            self.codes[name] = code
+            self.names.append(name)
+            return code
+
+    def encode(self, arguments: Tuple) -> Tuple:
+        return tuple([self.encode_symbol(name) for name in arguments])
+
+    def lookup(self, name) -> int:
+        """ Code for a name without adding it. Unknown names get -1, which matches nothing. """
+        return self.codes.get(name, -1)
+
+    def decode(self, codes: Tuple) -> Tuple:
+        return tuple([self.names[code] for code in codes])
+
+    def __len__(self):
+        return len(self.names)
+
+    def load(self, names: List) -> None:
+        """ Bring this table in line with another process's, so that codes mean the same
+        thing in both. Names this table already knows must have the same codes.
+        """
+        for code, name in enumerate(names):
+            if code < len(self.names):
+                if self.names[code] != name:
+                    raise RuntimeError(f"symbol {code} is {self.names[code]!r} here but {name!r} in the source table")
+            elif self.encode_symbol(name) != code:
+                raise RuntimeError(f"symbol {name!r} is already known under another code")
+
+
+# The one symbol table shared by every fact and knowledge store
+SYMBOLS = SymbolTable()
+
+
+# Every distinct fact still in use, keyed by (fact class, arguments).
+# Knowledge only keeps encoded arguments, so a fact nothing else holds is let go,
+# and built again, the same, if it's asked for again.
+FACT_TABLE = weakref.WeakValueDictionary()
+# The same facts keyed by (functor, encoded arguments), the way knowledge stores them
+ENCODED_FACTS = weakref.WeakValueDictionary()
+# functor -> the fact class that builds it, for fact_for to rebuild facts let go
+FACT_CLASSES = {}
+
+# functor -> random 64 bit key, that the Zobrist keys of its facts are mixed from.
+# Seeded so that the same functors seen in the same order hash the same from run to run.
+ZOBRIST_RANDOM = random.Random(0x5EED)
+FUNCTOR_KEYS = {}
+MASK_64 = (1 << 64) - 1
+
+
+def zobrist_key(functor, encoded: Tuple) -> int:
+    """ The Zobrist key of a fact, the same every time it's built in this process,
+    so that state hashes don't depend on whether its fact was let go in between.
+    Each argument code is mixed in turn into the functor's key, by splitmix64.
+    """
+    try:
+        key = FUNCTOR_KEYS[functor]
+    except KeyError:
+        key = FUNCTOR_KEYS[functor] = ZOBRIST_RANDOM.getrandbits(64)
+    for code in encoded:
+        key = (key ^ code) + 0x9E3779B97F4A7C15 & MASK_64
+        key = (key ^ (key >> 30)) * 0xBF58476D1CE4E5B9 & MASK_64
+        key = (key ^ (key >> 27)) * 0x94D049BB133111EB & MASK_64
+        key ^= key >> 31
+    return key
+
+
+class InternedFact(type):
+    """ Metaclass for facts. Building a fact that already exists hands back the existing
+    instance, so each distinct fact is a singleton with its hash computed once.
+    """
+    def __call__(cls, *arguments):
+        key = (cls, arguments)
+        try:
+            return FACT_TABLE[key]
+        except KeyError:
+            pass
+
+        fact = super().__call__(*arguments)
+        fact.hash_value = hash((fact.functor, fact.arguments))
+        fact.encoded = SYMBOLS.encode(fact.arguments)
+        fact.zobrist = zobrist_key(fact.functor, fact.encoded)
+        FACT_TABLE[key] = fact
+        ENCODED_FACTS[(fact.functor, fact.encoded)] = fact
+        FACT_CLASSES.setdefault(fact.functor, cls)
+        return fact
+
+
+def fact_for(functor, encoded: Tuple) -> 'Fact':
+    """ The interned fact behind an encoded argument tuple found in knowledge. """
+    try:
+        return ENCODED_FACTS[(functor, encoded)]
+    except KeyError:
+        # let go since, build it again
+        return FACT_CLASSES[functor](*SYMBOLS.decode(encoded))
+
+
+class Fact(metaclass=InternedFact):
     def __init__(self):
         self.functor = None
         self.arguments = ()
 
     def __eq__(self, other) -> bool:
         """ Compare the two fixed axioms """
-        if self.functor != other.functor:
+        # interned facts are equal only to themselves
+        if self is other:
+            return True
+        if not isinstance(other, Fact):
             return False
-        if len(self.arguments) != len(other.arguments):
-            return False
-        if hash(self.arguments) != hash(other.arguments):
-            return False
-        
-        return True
+        return self.functor == other.functor and self.arguments == other.arguments
     
     def __hash__(self):
-        return hash((self.functor, self.arguments))
+        return self.hash_value
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        # facts are immutable singletons, copies of knowledge keep sharing them
+        return self
+
+    def __reduce__(self):
+        # unpickling goes back through the intern table
+        return (type(self), self.arguments)
     
     
 class Proposal():
@@ -61,46 +183,313 @@ class Proposal():
         
         self.variables = []
         self.fixed_arguments = []
+        # symbol codes of the fixed arguments, None where there is a variable
+        encoded = []
         for i in range(len(self.arguments)):
             if isinstance(self.arguments[i], Variable):
                 self.arguments[i].cache_results()
                 self.variables.append(i)
+                encoded.append(None)
             else:
                 self.fixed_arguments.append(i)
+                encoded.append(SYMBOLS.lookup(self.arguments[i]))
+        self.encoded = tuple(encoded)
 
     def consider(self, arguments) -> bool:
+        """ arguments is an encoded tuple, as stored in knowledge. """
         # We assume that the functor has already matched
         if len(arguments) == len(self.arguments):
             # fixed arguments must match
             for index in self.fixed_arguments:
-                if arguments[index] != self.arguments[index]:
+                if arguments[index] != self.encoded[index]:
                     return False
             # unfixed arguments are unioned to existing variables
             for index in self.variables:
-                self.arguments[index].add_possibility(arguments[index])
+                self.arguments[index].add_possibility(SYMBOLS.names[arguments[index]])
+
+
+
+class Pattern:
+    """ An encoded argument tuple with None where the argument is unknown.
+    Knowledge looks up candidates for it exactly as it does for a Proposal.
+    """
+    __slots__ = ('functor', 'encoded', 'fixed_arguments')
+
+    def __init__(self, functor, encoded: Tuple, fixed_arguments: List[int]=None):
+        self.functor = functor
+        self.encoded = encoded
+        if fixed_arguments is None:
+            fixed_arguments = [i for i in range(len(encoded)) if encoded[i] is not None]
+        self.fixed_arguments = fixed_arguments
+
 
+class Query:
+    """ A conjunction of atoms sharing variables, eg
+        Query( (AT, (agent, location)), (TRIGGER, (gate1, gate2, location)) )
+    Variables are Variable objects, used here only as placeholders: solve() returns
+    whole binding tuples, one per solution, rather than filling possible_values, 
+    so variables stay linked to each other.
+
+    Atoms are joined one at a time, each looked up through the argument indexes with
+    the variables bound so far as fixed arguments. The next atom is always the one 
+    with the fewest candidates under the current bindings.
+    """
+    def __init__(self, *atoms):
+        # variables in order of first appearance, which is the order of the binding tuples
+        self.variables = []
+        # per atom: functor, and per argument either a symbol code or a variable number
+        self.atoms = []
+        # functors the answer depends on, for VersionedMemo
+        self.functors = []
+        for functor, arguments in atoms:
+            if functor not in self.functors:
+                self.functors.append(functor)
+            terms = []
+            for argument in arguments:
+                if isinstance(argument, Variable):
+                    if argument not in self.variables:
+                        self.variables.append(argument)
+                    terms.append(self.variables.index(argument))
+                else:
+                    # the query outlives this call, so the symbol has to exist for later worlds
+                    terms.append(-1 - SYMBOLS.encode_symbol(argument))
+            self.atoms.append((functor, tuple(terms)))
+
+    def solve(self, knowledge) -> List[Tuple]:
+        """ Every binding of the variables that makes all the atoms true, as tuples of names. """
+        names = SYMBOLS.names
+        return [tuple(names[code] for code in binding) for binding in self.solve_encoded(knowledge)]
+
+    def solve_encoded(self, knowledge) -> List[Tuple]:
+        """ As solve(), with symbol codes instead of names. """
+        solutions = []
+        self._join(knowledge, list(range(len(self.atoms))), [None] * len(self.variables), solutions)
+        return solutions
+
+    def _pattern(self, atom: int, binding: List) -> Pattern:
+        functor, terms = self.atoms[atom]
+        encoded = []
+        fixed_arguments = []
+        for position, term in enumerate(terms):
+            # negative terms are constants, the rest index into the binding
+            value = -1 - term if term < 0 else binding[term]
+            encoded.append(value)
+            if value is not None:
+                fixed_arguments.append(position)
+        return Pattern(functor, tuple(encoded), fixed_arguments)
+
+    def _join(self, knowledge, remaining: List[int], binding: List, solutions: List) -> None:
+        if not remaining:
+            solutions.append(tuple(binding))
+            return
+
+        # Atoms whose arguments are all bound are just tested. Of the others
+        # the most selective is joined next, no need to count if there's only one.
+        best = None
+        rest = []
+        for atom in remaining:
+            pattern = self._pattern(atom, binding)
+            if len(pattern.fixed_arguments) == len(pattern.encoded):
+                if pattern.encoded not in knowledge.flatten(pattern.functor):
+                    return
+                continue
+            rest.append(atom)
+            if len(remaining) == 1:
+                best, best_pattern = atom, pattern
+                break
+            size = knowledge.count(pattern)
+            if size == 0:
+                return
+            if best is None or size < best_size:
+                best, best_pattern, best_size = atom, pattern, size
+
+        if best is None:
+            # everything left was bound and true
+            solutions.append(tuple(binding))
+            return
+        rest.remove(best)
+        terms = self.atoms[best][1]
+        encoded = best_pattern.encoded
+        for fact_arguments in knowledge.candidates(best_pattern):
+            if len(fact_arguments) != len(terms):
+                continue
+            # candidates only promise one fixed argument, check them all,
+            # and bind the free variables, which may repeat within the atom
+            bound = []
+            matched = True
+            for position, term in enumerate(terms):
+                value = fact_arguments[position]
+                if encoded[position] is not None:
+                    if value != encoded[position]:
+                        matched = False
+                        break
+                elif binding[term] is None:
+                    binding[term] = value
+                    bound.append(term)
+                elif binding[term] != value:
+                    matched = False
+                    break
+            if matched:
+                self._join(knowledge, rest, binding, solutions)
+            for term in bound:
+                binding[term] = None
+
+
+def new_version() -> object:
+    """ A stamp for the facts of a functor, unlike any other. Plain objects rather than a
+    counter, so stamps can't collide between processes: unpickled ones are new objects.
+    """
+    return object()
+
+
+# Version of a functor nothing was ever added to. Every knowledge agrees it has no facts.
+NO_VERSION = 0
+
+
+class VersionedMemo:
+    """ Answers to questions asked of knowledge, rules and queries mostly, reused until a 
+    functor they read changes. Knowledge stamps each functor with a version that is replaced
+    whenever the functor's facts change, and restored when a layer is popped, so an answer 
+    is keyed by the question and the versions of the functors it reads. It holds for any 
+    knowledge showing the same versions: the same state asked again, the same state after 
+    a relaxed planning graph popped its layers, or a sibling state that didn't touch them.
+
+    Answers are shared between callers, treat them as read only.
+    The least recently used entry is evicted once max_size is reached.
+    """
+    def __init__(self, max_size: int=4096):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, knowledge, key, functors, compute: Callable):
+        """ compute(knowledge), or what it returned last time with the same versions of functors. """
+        full_key = (key, knowledge.versions_of(functors))
+        try:
+            value = self.entries[full_key]
+        except KeyError:
+            self.misses += 1
+            value = compute(knowledge)
+            self.entries[full_key] = value
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+            return value
+
+        self.entries.move_to_end(full_key)
+        self.hits += 1
+        return value
+
+    def bind(self, key, functors, compute: Callable) -> Callable:
+        """ compute as a memoized function of knowledge. key must tell it apart from 
+        everything else asked of this memo. 
+        """
+        functors = tuple(functors)
+        def memoized(knowledge):
+            return self.get(knowledge, key, functors, compute)
+        return memoized
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return self.hits / lookups
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# Empty result for a functor or argument with no known facts
+NO_FACTS = frozenset()
+
+
+class ArgumentIndex:
+    """ The argument tuples of one functor, bucketed by the value found at each position.
+    Lets a proposal with fixed arguments visit only the tuples that can match.
+    """
+    def __init__(self):
+        # one dict per argument position: value -> set of argument tuples
+        self.positions = []
+
+    def add(self, arguments: Tuple) -> None:
+        while len(self.positions) < len(arguments):
+            self.positions.append({})
+
+        for position, value in enumerate(arguments):
+            try:
+                self.positions[position][value].add(arguments)
+            except KeyError:
+                self.positions[position][value] = {arguments}
+
+    def discard(self, arguments: Tuple) -> None:
+        for position, value in enumerate(arguments):
+            try:
+                self.positions[position][value].discard(arguments)
+            except (IndexError, KeyError):
+                pass
+
+    def lookup(self, position: int, value) -> Set[Tuple]:
+        if position >= len(self.positions):
+            return NO_FACTS
+        return self.positions[position].get(value, NO_FACTS)
+
+    def best_lookup(self, proposal: Proposal) -> Set[Tuple]:
+        """ The smallest bucket among the proposal's fixed arguments. """
+        best = None
+        for position in proposal.fixed_arguments:
+            bucket = self.lookup(position, proposal.encoded[position])
+            if best is None or len(bucket) < len(best):
+                best = bucket
+        return best
 
 
 class BaseKnowledge():
     """ Flat Knowledge contains all of the facts that are known.
     """
     def __init__(self):
-        """ Facts are arranged by functor. Each functor has a set of known argument tuples. """
+        """ Facts are arranged by functor. Each functor has a set of known argument tuples,
+        encoded through SYMBOLS.
+        """
         self.facts = {}
+        # functor -> ArgumentIndex over the same tuples
+        self.indexes = {}
 
     def append(self, fact: Fact) -> None:
         try:
-            self.facts[fact.functor].add(fact.arguments)
+            self.facts[fact.functor].add(fact.encoded)
         except KeyError:
-            self.facts[fact.functor] = {fact.arguments}
+            self.facts[fact.functor] = {fact.encoded}
+            self.indexes[fact.functor] = ArgumentIndex()
+        self.indexes[fact.functor].add(fact.encoded)
 
     def test(self, fact: Fact):
         """ Test if the proposed fact is known. """
-        return fact.arguments in self.facts[fact.functor]
+        return fact.encoded in self.facts[fact.functor]
+
+    def candidates(self, proposal: Proposal) -> Set[Tuple]:
+        """ Argument tuples that might satisfy the proposal, narrowed by the argument index. """
+        if not proposal.fixed_arguments:
+            return self.facts.get(proposal.functor, NO_FACTS)
+        try:
+            return self.indexes[proposal.functor].best_lookup(proposal)
+        except KeyError:
+            return NO_FACTS
     
+    def count(self, proposal: Proposal) -> int:
+        """ Upper bound on the number of tuples matching the proposal. """
+        return len(self.candidates(proposal))
+
+    def lookup(self, functor, position: int, value: int) -> Set[Tuple]:
+        """ Argument tuples of functor with the symbol code value at position. """
+        try:
+            return self.indexes[functor].lookup(position, value)
+        except KeyError:
+            return NO_FACTS
+
     def find_possible_solutions(self, proposal):
         if isinstance(proposal, Proposal):
-            for fact_arguments in self.facts[proposal.functor]:
+            for fact_arguments in self.candidates(proposal):
                 proposal.consider(fact_arguments)
         else: # this is a Rule
             proposal.solve(self)
@@ -110,6 +499,8 @@ class KnowledgeDelta:
     def __init__(self):
         self.adds = {}
         self.deletes = {}
+        # functor -> ArgumentIndex over the adds
+        self.add_indexes = {}
 
     def append(self, fact: Fact) -> None:
         try:
@@ -117,8 +508,14 @@ class KnowledgeDelta:
         except KeyError:           
             functor_set = set()
             self.adds[fact.functor] = functor_set
+            self.add_indexes[fact.functor] = ArgumentIndex()
 
-        functor_set.add(fact.arguments)
+        functor_set.add(fact.encoded)
+        self.add_indexes[fact.functor].add(fact.encoded)
+
+        # a fact removed earlier in this layer and then re-added is true again
+        if fact.functor in self.deletes:
+            self.deletes[fact.functor].discard(fact.encoded)
 
     def remove(self, fact: Fact) -> None:
         try:
@@ -127,17 +524,145 @@ class KnowledgeDelta:
             functor_set = set()
             self.deletes[fact.functor] = functor_set
 
-        functor_set.add(fact.arguments)
+        functor_set.add(fact.encoded)
+
+        if fact.functor in self.adds:
+            self.adds[fact.functor].discard(fact.encoded)
+            self.add_indexes[fact.functor].discard(fact.encoded)
+
 
 class KnowledgeStack:
-    def __init__(self):
+    def __init__(self, static_functors=()):
         self.current_layer = 0
         self.base = BaseKnowledge()
         self.layers = []
 
+        # Static facts never change during a plan (paths, triggers...). They live in their
+        # own store, which is shared by every snapshot and copy of this stack and never
+        # appears in a layer. Only fluents go through the base and layers.
+        self.static_functors = frozenset(static_functors)
+        self.static = BaseKnowledge()
+        self.static_shared = False
+
+        # Layers at or below this depth are shared with another stack (0 is the base).
+        # Whoever writes to a shared layer first takes a private copy of it.
+        self.shared_depth = -1
+
+        # Flattened facts per functor, one dict for the base and one per layer.
+        # A layer that doesn't touch a functor shares the set of the layer below it.
+        # Sets listed in owned_views belong to that layer alone and are updated in place,
+        # all others are dropped on write and rebuilt on the next read.
+        self.views = [{}]
+        self.owned_views = [set()]
+
+        # Zobrist hash of the fluent facts true in the current layer: the xor of their keys.
+        # Kept up to date by append and remove, with the value below each layer saved for pop.
+        self.state_hash = 0
+        self.layer_hashes = []
+
+        # Version of each functor's facts in the current layer, see VersionedMemo.
+        # A functor's version is replaced when its facts change. Each layer saves
+        # the versions it replaced, so popping it brings them back.
+        self.versions = {}
+        self.layer_versions = []
+
+    def snapshot(self) -> 'KnowledgeStack':
+        """ Cheap copy of the stack for a successor state.
+        The base and every existing layer are shared with the parent rather than copied,
+        so a successor only pays for the delta it pushes on top.
+        """
+        clone = KnowledgeStack.__new__(KnowledgeStack)
+        clone.current_layer = self.current_layer
+        clone.base = self.base
+        clone.layers = list(self.layers)
+
+        clone.static_functors = self.static_functors
+        clone.static = self.static
+        clone.static_shared = self.static_shared = True
+
+        clone.shared_depth = self.current_layer
+        self.shared_depth = self.current_layer
+
+        # views are shared too, so neither side may update them in place anymore
+        clone.views = list(self.views)
+        self.owned_views = [set() for _ in self.owned_views]
+        clone.owned_views = [set() for _ in self.owned_views]
+
+        clone.state_hash = self.state_hash
+        clone.layer_hashes = list(self.layer_hashes)
+
+        # Both sides go on with the same versions, that's what lets siblings share answers.
+        # The saved versions may be shared too, both would save the same ones.
+        clone.versions = dict(self.versions)
+        clone.layer_versions = list(self.layer_versions)
+        return clone
+
+    def __deepcopy__(self, memo):
+        """ Deep copies still share the static store, copy-on-write. """
+        clone = KnowledgeStack.__new__(KnowledgeStack)
+        memo[id(self)] = clone
+        for name, value in self.__dict__.items():
+            if name == 'versions':
+                # the copy holds the same facts, keep the stamps rather than copies of them
+                clone.versions = dict(value)
+            elif name == 'layer_versions':
+                clone.layer_versions = [dict(saved) for saved in value]
+            elif name != 'static':
+                setattr(clone, name, copy.deepcopy(value, memo))
+
+        clone.static = self.static
+        clone.static_shared = self.static_shared = True
+        return clone
+
+    def is_static(self, functor) -> bool:
+        return functor in self.static_functors
+
+    def version(self, functor) -> object:
+        """ Stamp of functor's facts, the same until they change. """
+        return self.versions.get(functor, NO_VERSION)
+
+    def versions_of(self, functors: Tuple) -> Tuple:
+        versions = self.versions
+        return tuple([versions.get(functor, NO_VERSION) for functor in functors])
+
+    def _touch(self, functor) -> None:
+        """ functor's facts changed in the current layer, give them a new version. """
+        if self.layer_versions:
+            saved = self.layer_versions[-1]
+            if functor not in saved:
+                saved[functor] = self.versions.get(functor, NO_VERSION)
+        self.versions[functor] = new_version()
+
+    def _append_static(self, fact: Fact) -> None:
+        if self.current_layer != 0:
+            raise ValueError(f"static fact {fact} can only be added to the base layer")
+
+        if self.static_shared:
+            self.static = copy.deepcopy(self.static)
+            self.static_shared = False
+        self.static.append(fact)
+
+    def _unshare_current_layer(self) -> None:
+        """ Copy-on-write: take a private copy of the layer we are about to write to. """
+        if self.current_layer > self.shared_depth:
+            return
+
+        if self.current_layer == 0:
+            self.base = copy.deepcopy(self.base)
+            # the base views point into the old base
+            self.views[0] = {}
+        else:
+            self.layers[self.current_layer-1] = copy.deepcopy(self.layers[self.current_layer-1])
+            self.views[self.current_layer] = dict(self.views[self.current_layer])
+        self.shared_depth = self.current_layer - 1
+
     def push_layer(self) -> int:
         self.current_layer += 1
         self.layers.append(KnowledgeDelta())
+        self.views.append({})
+        self.owned_views.append(set())
+        self.layer_hashes.append(self.state_hash)
+        self.layer_versions.append({})
         return self.current_layer 
 
     def pop_layer(self) -> int:
@@ -146,63 +671,191 @@ class KnowledgeStack:
             return -1
         
         self.layers.pop()
+        self.views.pop()
+        self.owned_views.pop()
+        self.state_hash = self.layer_hashes.pop()
+        self.versions.update(self.layer_versions.pop())
         self.current_layer -= 1
+        self.shared_depth = min(self.shared_depth, self.current_layer)
         return self.current_layer
     
-    def append(self, fact: Fact) -> None:
-        if self.current_layer == 0:
+    def append(self, fact: Fact) -> bool:
+        """ Make fact true in the current layer. Returns False if it already was. """
+        # don't append a fact that is already true
+        if self.check_fact(fact):
+            return False
+
+        if fact.functor in self.static_functors:
+            self._append_static(fact)
+        elif self.current_layer == 0:
+            self._unshare_current_layer()
             self.base.append(fact)
+            self.views[0].pop(fact.functor, None)
+            self.state_hash ^= fact.zobrist
         else:        
-            # don't append a fact that is already true
-            if not self.check_fact(fact):
-                self.layers[self.current_layer-1].append(fact)
+            self._unshare_current_layer()
+            self.layers[self.current_layer-1].append(fact)
+            self._own_view(fact.functor).add(fact.encoded)
+            self.state_hash ^= fact.zobrist
+        self._touch(fact.functor)
+        return True
 
     def remove(self, fact: Fact) -> None:
+        if fact.functor in self.static_functors:
+            raise ValueError(f"static fact {fact} cannot be removed")
+
         if self.current_layer == 0:
             # Base layer is only positive
             return
         
         # don't remove a fact that isn't already true
         if self.check_fact(fact):
+            self._unshare_current_layer()
             self.layers[self.current_layer-1].remove(fact)
+            self._own_view(fact.functor).discard(fact.encoded)
+            self.state_hash ^= fact.zobrist
+            self._touch(fact.functor)
+
+    def _own_view(self, functor) -> Set[Tuple]:
+        """ The current layer's view of functor, copied first if it is shared. """
+        owned = self.owned_views[self.current_layer]
+        view = self.flatten(functor)
+        if functor not in owned:
+            view = set(view)
+            self.views[self.current_layer][functor] = view
+            owned.add(functor)
+        return view
 
     def flatten(self, functor) -> Set[Tuple]:
+        """ All argument tuples of functor that are true in the current layer, encoded 
+        through SYMBOLS. The set is cached and shared, so treat it as read only.
+        """
+        if functor in self.static_functors:
+            return self.static.facts.get(functor, NO_FACTS)
+
         try:
-            flattened = copy.copy(self.base.facts[functor])
+            return self.views[self.current_layer][functor]
         except KeyError:
-            flattened = set()
+            pass
+
+        # find the closest layer below that already flattened this functor
+        layer = self.current_layer
+        while layer > 0 and functor not in self.views[layer-1]:
+            layer -= 1
+
+        if layer == 0:
+            flattened = self.base.facts.get(functor, NO_FACTS)
+            self.views[0][functor] = flattened
+            layer = 1
+        else:
+            flattened = self.views[layer-1][functor]
 
-        layer = 1
         while layer <= self.current_layer:
-            # add and remove according to current layer
-            if functor in self.layers[layer-1].adds:
-                for args in self.layers[layer-1].adds[functor]:
-                    flattened.add(args)
-            if functor in self.layers[layer-1].deletes:
-                for args in self.layers[layer-1].deletes[functor]:
-                    flattened.discard(args)
-                
+            # add and remove according to each layer, copying only when the layer changes something
+            delta = self.layers[layer-1]
+            adds = delta.adds.get(functor)
+            deletes = delta.deletes.get(functor)
+            if adds or deletes:
+                flattened = set(flattened)
+                if adds:
+                    flattened.update(adds)
+                if deletes:
+                    flattened.difference_update(deletes)
+            self.views[layer][functor] = flattened
             layer += 1
 
         return flattened
     
     def check_fact(self, fact: Fact) -> bool:
-        flattened_knowledge = self.flatten(fact.functor)  
-
-        for fact_arguments in flattened_knowledge:
-            if fact_arguments == fact.arguments:
-                return True
-        return False  
+        return fact.encoded in self.flatten(fact.functor)
     
+    def candidates(self, proposal: Proposal) -> Set[Tuple]:
+        """ Argument tuples true in the current layer that might satisfy the proposal, 
+        narrowed by the argument indexes. Only one fixed argument is guaranteed to match.
+        """
+        if proposal.functor in self.static_functors:
+            return self.static.candidates(proposal)
+
+        flattened = self.flatten(proposal.functor)
+        if not proposal.fixed_arguments:
+            return flattened
+
+        candidates = self.base.candidates(proposal)
+        if flattened is self.base.facts.get(proposal.functor):
+            # no layer has touched this functor, the base index is the whole answer
+            return candidates
+
+        # otherwise gather candidates from the base and every layer's adds,
+        # keeping only those that are still true in the current layer
+        found = {fact_arguments for fact_arguments in candidates if fact_arguments in flattened}
+        for layer in range(self.current_layer):
+            delta = self.layers[layer]
+            if proposal.functor in delta.add_indexes:
+                for fact_arguments in delta.add_indexes[proposal.functor].best_lookup(proposal):
+                    if fact_arguments in flattened:
+                        found.add(fact_arguments)
+        return found
+
+    def lookup(self, functor, position: int, value: int):
+        """ Argument tuples of functor true in the current layer with the symbol code value
+        at position. For code that reads the indexes directly, eg compiled rules.
+        """
+        if functor in self.static_functors:
+            return self.static.lookup(functor, position, value)
+
+        flattened = self.flatten(functor)
+        found = self.base.lookup(functor, position, value)
+        if flattened is self.base.facts.get(functor):
+            return found
+
+        found = {fact_arguments for fact_arguments in found if fact_arguments in flattened}
+        for delta in self.layers[:self.current_layer]:
+            if functor in delta.add_indexes:
+                for fact_arguments in delta.add_indexes[functor].lookup(position, value):
+                    if fact_arguments in flattened:
+                        found.add(fact_arguments)
+        return found
+
+    def count(self, proposal: Proposal) -> int:
+        """ Upper bound on the number of candidates, without gathering them. """
+        if proposal.functor in self.static_functors:
+            return self.static.count(proposal)
+
+        flattened = self.flatten(proposal.functor)
+        if proposal.fixed_arguments and flattened is self.base.facts.get(proposal.functor):
+            return len(self.base.candidates(proposal))
+        # Fluents are few, it's not worth visiting every layer's index for a closer bound
+        return len(flattened)
+
     def find_possible_solutions(self, proposal: Proposal):
-        # One wonders if this will become a performance issue
-        # We may want to cache this.
-        # Note that this is a shallow copy so the facts themselves persist
-        flattened_knowledge = self.flatten(proposal.functor)
-        
-        for fact_arguments in flattened_knowledge:
+        for fact_arguments in self.candidates(proposal):
             proposal.consider(fact_arguments)
 
+    def fluent_delta(self, base: BaseKnowledge=None) -> Tuple[List[Fact], List[Fact]]:
+        """ The fluent facts added and deleted going from base to the current layer.
+        base defaults to our own base, in which case only functors touched by a layer
+        are compared. Used to ship a state to another process as a small change list.
+        """
+        if base is None or base is self.base:
+            base = self.base
+            functors = set()
+        else:
+            functors = set(base.facts) | set(self.base.facts)
+        for layer in range(self.current_layer):
+            functors.update(self.layers[layer].adds)
+            functors.update(self.layers[layer].deletes)
+
+        adds = []
+        deletes = []
+        for functor in functors:
+            if functor in self.static_functors:
+                continue
+            flattened = self.flatten(functor)
+            original = base.facts.get(functor, NO_FACTS)
+            adds.extend(fact_for(functor, args) for args in flattened - original)
+            deletes.extend(fact_for(functor, args) for args in original - flattened)
+        return adds, deletes
+
     def facts_in_current_add(self):
         """ This is used in heuristic search to determine if we've reached a terminal state. """
         if self.current_layer == 0:
@@ -210,3 +863,350 @@ class KnowledgeStack:
         
         return len(self.layers[self.current_layer-1].adds)
 
+    def to_trail(self) -> 'TrailKnowledge':
+        """ The facts true in the current layer, as TrailKnowledge sharing our static store. """
+        trail = TrailKnowledge(self.static_functors)
+        trail.static = self.static
+        trail.static_shared = self.static_shared = True
+
+        functors = set(self.base.facts)
+        for delta in self.layers:
+            functors.update(delta.adds)
+        for functor in functors:
+            flattened = self.flatten(functor)
+            if flattened:
+                trail.facts[functor] = set(flattened)
+        trail.owned = set(trail.facts)
+        trail.state_hash = self.state_hash
+        # same facts, same versions
+        trail.versions = dict(self.versions)
+        return trail
+
+
+class TrailKnowledge:
+    """ The other way to keep knowledge: one set of facts per functor, changed in place,
+    and a trail of every change so that a layer can be popped by undoing its changes.
+    Queries are a plain set lookup however many layers are pushed, and pushing and popping
+    cost only the facts changed, where KnowledgeStack replays layers into cached views.
+    A snapshot shares the fact sets and the trail. Either side copies a functor's set
+    the first time it changes it, so a successor only pays for the functors it touches.
+
+    Offers the same interface as KnowledgeStack to search and the heuristics, and keeps
+    the same state_hash for the same facts, so either can be handed to SearchPlan.
+    Make one with KnowledgeStack.to_trail(), or fill it the same way as a stack.
+    """
+    def __init__(self, static_functors=()):
+        # static facts are kept and shared exactly as in KnowledgeStack
+        self.static_functors = frozenset(static_functors)
+        self.static = BaseKnowledge()
+        self.static_shared = False
+
+        # functor -> set of encoded argument tuples true right now
+        self.facts = {}
+        # functors whose sets are ours to change, the others may be shared with snapshots
+        self.owned = set()
+        # functor -> ArgumentIndex over the same tuples, built the first time it's needed
+        self.indexes = {}
+
+        # (fact, added) for every change made above the base layer, oldest first.
+        # Only real changes are recorded, so undoing one always flips the fact back.
+        # The older changes are in history, sealed when we were snapshotted:
+        # (changes, older history) tuples, shared with the snapshots.
+        self.trail = []
+        self.history = None
+        self.history_length = 0
+        # trail length, history included, and state hash at each push
+        self.marks = []
+        self.state_hash = 0
+
+        # fluent facts of the base layer, built when asked for, see base
+        self._base = None
+
+        # functor versions, kept as in KnowledgeStack
+        self.versions = {}
+        self.layer_versions = []
+
+    @property
+    def current_layer(self) -> int:
+        return len(self.marks)
+
+    def snapshot(self) -> 'TrailKnowledge':
+        """ Independent copy of the current facts and trail. 
+        The static store, the fact sets and the trail so far are shared until changed.
+        """
+        clone = TrailKnowledge.__new__(TrailKnowledge)
+        clone.static_functors = self.static_functors
+        clone.static = self.static
+        clone.static_shared = self.static_shared = True
+
+        # neither of us may change the sets in place from now on
+        clone.facts = dict(self.facts)
+        clone.owned = set()
+        self.owned = set()
+        clone.indexes = {}
+
+        # the changes since the last snapshot join the history we both undo from
+        self._seal()
+        clone.trail = []
+        clone.history = self.history
+        clone.history_length = self.history_length
+        clone.marks = list(self.marks)
+        clone.state_hash = self.state_hash
+        clone._base = self._base
+
+        # only the top layer's saved versions are ever changed, see pop_layer
+        clone.versions = dict(self.versions)
+        clone.layer_versions = list(self.layer_versions)
+        if clone.layer_versions:
+            clone.layer_versions[-1] = dict(clone.layer_versions[-1])
+        return clone
+
+    def __deepcopy__(self, memo):
+        clone = self.snapshot()
+        memo[id(self)] = clone
+        return clone
+
+    def __getstate__(self) -> dict:
+        # the history goes as one list, the chain of segments could be too deep to pickle
+        state = dict(self.__dict__)
+        state.update(trail=list(self._changes()), history=None, history_length=0, _base=None)
+        return state
+
+    def __setstate__(self, state: dict) -> None:
+        self.__dict__.update(state)
+        # unpickled sets are nobody else's
+        self.owned = set(self.facts)
+
+    @property
+    def base(self) -> BaseKnowledge:
+        """ The fluent facts of the base layer, as KnowledgeStack.base, eg for ParallelEvaluator.
+        Rebuilt from the trail the first time it's asked for, then shared with our snapshots
+        until the base layer changes.
+        """
+        if self._base is None:
+            adds, deletes = self.fluent_delta()
+            added = set(adds)
+            base = BaseKnowledge()
+            for functor, facts in self.facts.items():
+                for fact_arguments in facts:
+                    fact = fact_for(functor, fact_arguments)
+                    if fact not in added:
+                        base.append(fact)
+            for fact in deletes:
+                base.append(fact)
+            self._base = base
+        return self._base
+
+    def is_static(self, functor) -> bool:
+        return functor in self.static_functors
+
+    def version(self, functor) -> object:
+        """ Stamp of functor's facts, the same until they change. """
+        return self.versions.get(functor, NO_VERSION)
+
+    def versions_of(self, functors: Tuple) -> Tuple:
+        versions = self.versions
+        return tuple([versions.get(functor, NO_VERSION) for functor in functors])
+
+    def _touch(self, functor) -> None:
+        """ functor's facts changed in the current layer, give them a new version. """
+        if self.layer_versions:
+            saved = self.layer_versions[-1]
+            if functor not in saved:
+                saved[functor] = self.versions.get(functor, NO_VERSION)
+        self.versions[functor] = new_version()
+
+    def _append_static(self, fact: Fact) -> None:
+        if self.current_layer != 0:
+            raise ValueError(f"static fact {fact} can only be added to the base layer")
+
+        if self.static_shared:
+            self.static = copy.deepcopy(self.static)
+            self.static_shared = False
+        self.static.append(fact)
+
+    def _writable(self, functor) -> Set[Tuple]:
+        """ functor's set of facts, copied first if a snapshot may share it. """
+        if functor in self.owned:
+            return self.facts[functor]
+        facts = set(self.facts.get(functor, NO_FACTS))
+        self.facts[functor] = facts
+        self.owned.add(functor)
+        return facts
+
+    def _add(self, fact: Fact) -> None:
+        self._writable(fact.functor).add(fact.encoded)
+        if fact.functor in self.indexes:
+            self.indexes[fact.functor].add(fact.encoded)
+        self.state_hash ^= fact.zobrist
+
+    def _discard(self, fact: Fact) -> None:
+        self._writable(fact.functor).discard(fact.encoded)
+        if fact.functor in self.indexes:
+            self.indexes[fact.functor].discard(fact.encoded)
+        self.state_hash ^= fact.zobrist
+
+    def _seal(self) -> None:
+        """ Move the trail into the history, where snapshots can share it. """
+        if self.trail:
+            self.history = (tuple(self.trail), self.history)
+            self.history_length += len(self.trail)
+            self.trail = []
+
+    def _unseal(self) -> None:
+        """ Take the newest changes back out of the history, to undo them. """
+        changes, self.history = self.history
+        self.history_length -= len(changes)
+        self.trail = list(changes)
+
+    def _changes(self, mark: int=0):
+        """ The changes made since the trail was mark long, oldest first. """
+        segments = []
+        changes, history = self.trail, self.history
+        start = self.history_length
+        while True:
+            segments.append(changes if mark <= start else changes[mark - start:])
+            if history is None or start <= mark:
+                break
+            changes, history = history
+            start -= len(changes)
+        for changes in reversed(segments):
+            yield from changes
+
+    def push_layer(self) -> int:
+        self.marks.append((self.history_length + len(self.trail), self.state_hash))
+        self.layer_versions.append({})
+        return self.current_layer
+
+    def pop_layer(self) -> int:
+        if self.current_layer == 0:
+            # Base layer cannot be popped
+            return -1
+
+        mark, state_hash = self.marks.pop()
+        while self.history_length + len(self.trail) > mark:
+            if not self.trail:
+                self._unseal()
+            fact, added = self.trail.pop()
+            if added:
+                self._discard(fact)
+            else:
+                self._add(fact)
+        # the undo xors every key back out, but there's no need to trust it
+        self.state_hash = state_hash
+        self.versions.update(self.layer_versions.pop())
+        # the layer below may be shared with snapshots, and it's ours to change now
+        if self.layer_versions:
+            self.layer_versions[-1] = dict(self.layer_versions[-1])
+        return self.current_layer
+
+    def append(self, fact: Fact) -> bool:
+        """ Make fact true in the current layer. Returns False if it already was. """
+        if self.check_fact(fact):
+            return False
+
+        if fact.functor in self.static_functors:
+            self._append_static(fact)
+            self._touch(fact.functor)
+            return True
+
+        self._add(fact)
+        if self.current_layer > 0:
+            self.trail.append((fact, True))
+        else:
+            self._base = None
+        self._touch(fact.functor)
+        return True
+
+    def remove(self, fact: Fact) -> None:
+        if fact.functor in self.static_functors:
+            raise ValueError(f"static fact {fact} cannot be removed")
+
+        if self.current_layer == 0:
+            # Base layer is only positive
+            return
+
+        if self.check_fact(fact):
+            self._discard(fact)
+            self.trail.append((fact, False))
+            self._touch(fact.functor)
+
+    def flatten(self, functor) -> Set[Tuple]:
+        """ All argument tuples of functor that are true, encoded through SYMBOLS.
+        This is the live set, so treat it as read only and don't keep it across changes.
+        """
+        if functor in self.static_functors:
+            return self.static.facts.get(functor, NO_FACTS)
+        return self.facts.get(functor, NO_FACTS)
+
+    def check_fact(self, fact: Fact) -> bool:
+        return fact.encoded in self.flatten(fact.functor)
+
+    def candidates(self, proposal: Proposal) -> Set[Tuple]:
+        """ Argument tuples that might satisfy the proposal, narrowed by the argument index. """
+        if proposal.functor in self.static_functors:
+            return self.static.candidates(proposal)
+
+        if not proposal.fixed_arguments:
+            return self.facts.get(proposal.functor, NO_FACTS)
+        return self._index(proposal.functor).best_lookup(proposal)
+
+    def _index(self, functor) -> ArgumentIndex:
+        try:
+            return self.indexes[functor]
+        except KeyError:
+            index = ArgumentIndex()
+            for fact_arguments in self.facts.get(functor, NO_FACTS):
+                index.add(fact_arguments)
+            self.indexes[functor] = index
+            return index
+
+    def count(self, proposal: Proposal) -> int:
+        if proposal.functor in self.static_functors:
+            return self.static.count(proposal)
+        return len(self.candidates(proposal))
+
+    def lookup(self, functor, position: int, value: int) -> Set[Tuple]:
+        if functor in self.static_functors:
+            return self.static.lookup(functor, position, value)
+        return self._index(functor).lookup(position, value)
+
+    def find_possible_solutions(self, proposal: Proposal):
+        for fact_arguments in self.candidates(proposal):
+            proposal.consider(fact_arguments)
+
+    def fluent_delta(self, base: BaseKnowledge=None) -> Tuple[List[Fact], List[Fact]]:
+        """ The fluent facts added and deleted going from base to the current layer.
+        base defaults to the base layer, which the trail records the way back to.
+        """
+        adds = []
+        deletes = []
+        if base is not None and base is not self._base:
+            for functor in set(base.facts) | set(self.facts):
+                if functor in self.static_functors:
+                    continue
+                facts = self.facts.get(functor, NO_FACTS)
+                original = base.facts.get(functor, NO_FACTS)
+                adds.extend(fact_for(functor, args) for args in facts - original)
+                deletes.extend(fact_for(functor, args) for args in original - facts)
+            return adds, deletes
+
+        # the first change to a fact tells us whether the base layer had it
+        seen = set()
+        for fact, added in self._changes():
+            if fact in seen:
+                continue
+            seen.add(fact)
+            if added and self.check_fact(fact):
+                adds.append(fact)
+            elif not added and not self.check_fact(fact):
+                deletes.append(fact)
+        return adds, deletes
+
+    def facts_in_current_add(self):
+        """ This is used in heuristic search to determine if we've reached a terminal state. """
+        if self.current_layer == 0:
+            return 0
+
+        mark, _ = self.marks[-1]
+        return sum(1 for _, added in self._changes(mark) if added)
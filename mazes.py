@@ -0,0 +1,143 @@
+from typing import List
+import random
+
+import sys
+sys.path.append('D:\\projects')
+import cognate.knowledge as cog
+import cognate.bandits as band
+
+
+class Maze:
+    """ A generated bandit maze: the world, where the bandit starts and where it must go. """
+    def __init__(self, knowledge: cog.KnowledgeStack, agent: str, start: str, goal_location: str,
+                 parameters: dict, gates: int, triggers: int):
+        self.knowledge = knowledge
+        self.agent = agent
+        self.start = start
+        self.goal_location = goal_location
+        self.goal = band.At(agent, goal_location)
+
+        # what it was generated from, and what came out, for reports
+        self.parameters = parameters
+        self.gates = gates
+        self.triggers = triggers
+
+    def bandit(self) -> band.Bandit:
+        """ The maze's bandit, with its goal set. """
+        b = band.Bandit(self.agent)
+        b.set_goal(self.goal)
+        return b
+
+    def describe(self) -> dict:
+        return dict(self.parameters, gates=self.gates, trigger_locations=self.triggers)
+
+    def __repr__(self):
+        return (f"Maze {self.parameters['nodes']} nodes, {self.gates} gates, {self.triggers} trigger locations, "
+                f"goal {self.parameters['goal_distance']} steps from {self.start}")
+
+
+def generate_maze(nodes: int, branching: int=3, gate_density: float=0.1, trigger_density: float=0.05,
+                  goal_distance: int=None, seed: int=0, agent: str='bandit_A') -> Maze:
+    """ A random maze of nodes locations, n0 to n<nodes-1>, the same for the same arguments.
+
+    The locations form a tree, paths both ways along its edges, rooted at the start n0.
+    Each location leads on to at most branching others, not counting the way to the goal.
+    The goal is exactly goal_distance paths from the start, about the square root of
+    nodes by default.
+
+    Each edge is gated with probability gate_density, closed to begin with. Each location
+    hosts triggers with probability trigger_density, and every gate is flipped by a
+    trigger on a host that can be reached without going through it, so the goal can
+    always be reached. Fewer hosts means more gates per trigger, which all flip together.
+    """
+    if nodes < 2:
+        raise ValueError("a maze needs at least 2 nodes")
+    if branching < 1:
+        raise ValueError("branching must be at least 1")
+    if goal_distance is None:
+        goal_distance = max(1, round(nodes ** 0.5))
+    if not 0 < goal_distance < nodes:
+        raise ValueError(f"goal_distance must be between 1 and {nodes-1}")
+
+    rng = random.Random(seed)
+    names = [f"n{i}" for i in range(nodes)]
+    knowledge = cog.KnowledgeStack(band.STATIC_FUNCTORS)
+
+    # Locations are added in order, each one joined to an earlier one, either the end
+    # of the way to the goal or any location with room for another branch. Spreading
+    # the goal path over the whole order leaves side branches for trigger hosts before it.
+    children = [0] * nodes
+    # locations with room for a side branch. The tip of the goal path is kept
+    # out until it reaches the goal, so that it goes on growing.
+    open_parents = []
+    tip = 0
+    distance = 0
+    hosts = [0]
+    gates = 0
+    for node in range(1, nodes):
+        remaining = nodes - node
+        if distance < goal_distance and (not open_parents or 
+                                         rng.random() < (goal_distance - distance) / remaining):
+            # the goal path doesn't count as a branch, the old tip has room for them all
+            parent = tip
+            open_parents.append(tip)
+            tip = node
+            distance += 1
+            if distance == goal_distance:
+                open_parents.append(tip)
+        else:
+            index = rng.randrange(len(open_parents))
+            parent = open_parents[index]
+            children[parent] += 1
+            if children[parent] == branching:
+                # swap remove, the order doesn't matter as long as it's the same every time
+                open_parents[index] = open_parents[-1]
+                open_parents.pop()
+            open_parents.append(node)
+
+        a, b = names[parent], names[node]
+        knowledge.append( band.Path(a, b) )
+        knowledge.append( band.Path(b, a) )
+
+        if rng.random() < gate_density:
+            # every host so far is reachable without this gate
+            host = names[hosts[rng.randrange(len(hosts))]]
+            knowledge.append( band.ClosedGate(a, b) )
+            knowledge.append( band.ClosedGate(b, a) )
+            knowledge.append( band.Trigger(a, b, host) )
+            knowledge.append( band.Trigger(b, a, host) )
+            gates += 1
+
+        if rng.random() < trigger_density:
+            hosts.append(node)
+
+    knowledge.append( band.At(agent, names[0]) )
+
+    parameters = dict(nodes=nodes, branching=branching, gate_density=gate_density,
+                      trigger_density=trigger_density, goal_distance=goal_distance, seed=seed)
+    # only hosts that got a gate count
+    triggers = len(set(cog.SYMBOLS.decode(args)[2] for args in knowledge.flatten(band.Functor.TRIGGER)))
+    return Maze(knowledge, agent, names[0], names[tip], parameters, gates, triggers)
+
+
+def path_to_goal(maze: Maze) -> List[str]:
+    """ Locations from the start to the goal, ignoring gates. For checking generated mazes. """
+    neighbours = {}
+    for node1, node2 in sorted(cog.SYMBOLS.decode(args) for args in maze.knowledge.flatten(band.Functor.PATH)):
+        neighbours.setdefault(node1, []).append(node2)
+
+    parents = {maze.start: None}
+    frontier = [maze.start]
+    while frontier:
+        following = []
+        for location in frontier:
+            for destination in neighbours.get(location, ()):
+                if destination not in parents:
+                    parents[destination] = location
+                    following.append(destination)
+        frontier = following
+
+    path = [maze.goal_location]
+    while parents[path[-1]] is not None:
+        path.append(parents[path[-1]])
+    return list(reversed(path))
@@ -1,11 +1,20 @@
 import copy
+import gc
+import json
+import os
 import sys
+import tempfile
 sys.path.append("D:\\projects\\")
 
 import cognate.knowledge as cog
 import cognate.bandits as band
 import cognate.heuristic as heu
 import cognate.search as search
+import cognate.parallel as parallel
+import cognate.shared_knowledge as shared_knowledge
+import cognate.mazes as mazes
+import cognate.instrumentation as instrumentation
+import cognate.tracing as tracing
 
 
 
@@ -17,6 +26,30 @@ def test_trigger():
     print(gate1)   
 
 
+def test_knowledge_layers():
+    test_k = band.k.snapshot()
+    test_k.append( band.At('bandit_A', 'junction') )
+
+    test_k.push_layer()
+    test_k.append( band.At('bandit_A', 'path_a') )
+    test_k.remove( band.At('bandit_A', 'junction') )
+    successor = test_k.snapshot()
+    test_k.pop_layer()
+
+    # knowledge stores symbol codes, decode them for display
+    print({cog.SYMBOLS.decode(args) for args in test_k.flatten(band.Functor.AT)}) # {('bandit_A', 'junction')}
+    print({cog.SYMBOLS.decode(args) for args in successor.flatten(band.Functor.AT)}) # {('bandit_A', 'path_a')}
+
+    # removing and re-adding in the same layer leaves the fact true
+    successor.push_layer()
+    successor.remove( band.At('bandit_A', 'path_a') )
+    successor.append( band.At('bandit_A', 'path_a') )
+    print(successor.check_fact( band.At('bandit_A', 'path_a') )) # True
+
+    # the shared maze is untouched
+    print(band.k.check_fact( band.At('bandit_A', 'junction') )) # False
+
+
 def test_move_action():
     band.k.append( band.At('bandit_A', 'junction') )
     b = band.Bandit('bandit_A')
@@ -61,6 +94,33 @@ def test_relaxed_planning_graph():
     print(actions)
 
 
+def test_counting_relaxed_planning_graph():
+    b = band.Bandit('bandit_A')
+    b.set_goal(band.At('bandit_A', 'end'))
+
+    # both engines should agree
+    for start in ('junction', 'path_a', 'path_b1', 'trigger_c'):
+        test_k = copy.deepcopy(band.k)
+        test_k.append( band.At('bandit_A', start) )
+        layered = heu.RelaxedPlanningGraph(test_k, b).generate_heuristic()
+        counting = heu.CountingRelaxedPlanningGraph(test_k, b).generate_heuristic()
+        print(f"from {start}: {layered[0]} {counting[0]} {counting[1]}")
+        assert layered[0] == counting[0], start
+
+    # a gate closed after the task was compiled is still a gate
+    b.set_goal(band.At('bandit_A', 'junction'))
+    test_k = copy.deepcopy(band.k)
+    test_k.append( band.At('bandit_A', 'path_b') )
+    print(heu.CountingRelaxedPlanningGraph(test_k, b).generate_heuristic()[0]) # 1
+    gated = test_k.snapshot()
+    gated.push_layer()
+    gated.append( band.ClosedGate('path_b', 'junction') )
+    layered = heu.RelaxedPlanningGraph(gated.snapshot(), b).generate_heuristic()
+    counting = heu.CountingRelaxedPlanningGraph(gated, b).generate_heuristic()
+    print(layered[0] == counting[0] == heu.DEAD_END) # True
+    print(heu.CountingRelaxedPlanningGraph(test_k, b).generate_heuristic()[0]) # 1
+
+
 def test_search_easy():
     b = band.Bandit('bandit_A')
     b.set_goal(band.At('bandit_A', 'path_b1'))
@@ -91,14 +151,323 @@ def test_search_hard():
 
     # this isn't determinsitic
     print(f"generated {s.dc_count} states") 
+    print(f"pruned {s.duplicate_count} duplicate states") 
+
+    s = search.SearchPlan(test_k, b, rpg=heu.CountingRelaxedPlanningGraph)
+    plan = s.plan()
+    print(f"counting RPG: {len(plan)} steps, generated {s.dc_count} states") 
+
+
+def test_search_replan():
+    b = band.Bandit('bandit_A')
+    b.set_goal(band.At('bandit_A', 'end'))
+
+    test_k = copy.deepcopy(band.k)
+    test_k.append( band.At('bandit_A', 'start') ) 
+
+    # replanning from the same state reuses every heuristic from the first plan
+    cache = heu.HeuristicCache()
+    first = search.SearchPlan(test_k, b, cache).plan()
+    print(cache)
+    second = search.SearchPlan(test_k, b, cache).plan()
+    print(cache)
+    print(len(first) == len(second)) # True
+
+    # nor does a cache hand one engine's heuristics to another
+    hits = cache.hits
+    search.SearchPlan(test_k, b, cache, rpg=heu.CountingRelaxedPlanningGraph).plan()
+    print(cache.hits == hits) # True
+
+
+def test_search_best_first():
+    b = band.Bandit('bandit_A')
+    b.set_goal(band.At('bandit_A', 'end'))
+
+    test_k = copy.deepcopy(band.k)
+    test_k.append( band.At('bandit_A', 'start') ) 
+
+    for strategy in (search.SearchPlan.GBFS, search.SearchPlan.WEIGHTED_A_STAR):
+        s = search.SearchPlan(test_k, b, strategy=strategy)
+        plan = s.plan()
+        print(f"{strategy}: {len(plan)} steps, generated {s.dc_count} states")
+
+    # lazy best first search only builds and evaluates the states it pops,
+    # and expands every one of them but the goal
+    evaluations = {}
+    for lazy in (False, True):
+        s = search.SearchPlan(test_k, b, strategy=search.SearchPlan.GBFS, lazy=lazy)
+        plan = s.plan()
+        evaluations[lazy] = s.evaluation_count
+        print(f"lazy {lazy}: {len(plan)} steps, {s.evaluation_count} evaluations, {s.expansions} expansions")
+    assert s.evaluation_count == s.expansions + 1
+    assert evaluations[True] < evaluations[False]
+
+    # an unreachable goal is a dead end for the relaxed plan, so no search is needed
+    b.set_goal(band.At('bandit_A', 'nowhere'))
+    s = search.SearchPlan(test_k, b)
+    print(s.plan(), s.dc_count) # None 0
+
+def test_search_step():
+    b = band.Bandit('bandit_A')
+    b.set_goal(band.At('bandit_A', 'end'))
+
+    test_k = copy.deepcopy(band.k)
+    test_k.append( band.At('bandit_A', 'start') ) 
+
+    # a few expansions per tick, the agent can follow progress.plan meanwhile
+    s = search.SearchPlan(test_k, b)
+    progress = s.step(max_expansions=3)
+    while not progress.finished:
+        print(progress)
+        progress = s.step(max_expansions=3)
+    print(progress)
+    print(f"generated {progress.dc_count} states") 
+
+def test_search_parallel():
+    b = band.Bandit('bandit_A')
+    b.set_goal(band.At('bandit_A', 'end'))
+
+    test_k = copy.deepcopy(band.k)
+    test_k.append( band.At('bandit_A', 'start') ) 
+
+    # the same search with successors evaluated in worker processes finds the same plan
+    s = search.SearchPlan(test_k, b, strategy=search.SearchPlan.GBFS)
+    print(f"serial: {len(s.plan())} steps, {s.evaluation_count} evaluations")
+    with parallel.ParallelEvaluator(test_k, b, workers=2) as evaluator:
+        s = search.SearchPlan(test_k, b, strategy=search.SearchPlan.GBFS, evaluator=evaluator)
+        print(f"parallel: {len(s.plan())} steps, {s.evaluation_count} evaluations, "
+              f"{evaluator.evaluations} in workers")
+
+        # the workers' engine and agent have to be the plan's
+        for rpg, agent in ((heu.CountingRelaxedPlanningGraph, b), (heu.RelaxedPlanningGraph, band.Bandit('bandit_B'))):
+            try:
+                search.SearchPlan(test_k, agent, rpg=rpg, evaluator=evaluator)
+            except ValueError as error:
+                print(error)
+
+def test_plan_batch():
+    # a crowd of bandits in one maze, each planning its own way out
+    test_k = copy.deepcopy(band.k)
+    requests = []
+    for i in range(8):
+        b = band.Bandit(f"bandit_{i}")
+        test_k.append( band.At(b.name, 'start') )
+        requests.append((b, band.At(b.name, 'end')))
+
+    report = parallel.plan_batch(test_k, requests, workers=2, strategy=search.SearchPlan.GBFS)
+    print(report)
+    print([len(plan) for plan in report.plans])
+
+def test_shared_static():
+    b = band.Bandit('bandit_A')
+    b.set_goal(band.At('bandit_A', 'end'))
+
+    test_k = copy.deepcopy(band.k)
+    test_k.append( band.At('bandit_A', 'start') ) 
+
+    # the static facts move to shared memory, queries read them from there
+    with shared_knowledge.share_static(test_k):
+        print(test_k.check_fact(band.Path('start', 'junction'))) # True
+        print(test_k.check_fact(band.Path('start', 'end'))) # False
+        exits = cog.Variable()
+        test_k.find_possible_solutions( cog.Proposal( band.Functor.PATH, ('junction', exits) ) )
+        print(exits.possible_values)
+
+        s = search.SearchPlan(test_k, b)
+        print(f"{len(s.plan())} steps")
+
+        # workers attach to the same memory
+        report = parallel.plan_batch(test_k, [(b, b.goal)] * 4, workers=2)
+        print(report)
+
+    # closing the shared store gives the stack its own static facts back
+    print(test_k.check_fact(band.Path('start', 'junction'))) # True
+
+def test_query():
+    test_k = copy.deepcopy(band.k)
+    test_k.append( band.At('bandit_A', 'junction') ) 
+    test_k.push_layer()
+    test_k.append( band.At('bandit_A', 'trigger_c') ) 
+
+    # every trigger the bandit is standing on, with the gates it controls,
+    # as linked tuples rather than one set of values per variable
+    location = cog.Variable()
+    gate1 = cog.Variable()
+    gate2 = cog.Variable()
+    query = cog.Query(
+        (band.Functor.AT, ('bandit_A', location)),
+        (band.Functor.TRIGGER, (gate1, gate2, location))
+    )
+    for solution in sorted(query.solve(test_k)):
+        print(solution) # ('junction', 'path_a', 'trigger_a') ...
+
+    # paths out of the bandit's locations that lead back to junction
+    there = cog.Variable()
+    query = cog.Query(
+        (band.Functor.AT, ('bandit_A', location)),
+        (band.Functor.PATH, (location, there)),
+        (band.Functor.PATH, (there, 'junction'))
+    )
+    print(sorted(query.solve(test_k)))
+
+def test_compiled_rule():
+    test_k = copy.deepcopy(band.k)
+    test_k.append( band.At('bandit_A', 'junction') ) 
+    test_k.push_layer()
+    test_k.append( band.At('bandit_A', 'path_a') ) 
+
+    # the rule behind CanMoveRule, compiled to a function
+    print(band.CAN_MOVE_RULE.source)
+    print(band.CAN_MOVE_RULE.solve(test_k, 'bandit_A', 'path_b')) # [('junction', 1)]
+    print(band.CAN_MOVE_RULE.solve(test_k, 'bandit_A', 'trigger_a')) # [] the gate is closed
+    print(band.CAN_TRIGGER_RULE.solve(test_k, 'bandit_A'))
+
+def test_trail_knowledge():
+    test_k = copy.deepcopy(band.k)
+    test_k.append( band.At('bandit_A', 'junction') ) 
+    trail = test_k.to_trail()
+
+    # a layer is undone from the trail
+    trail.push_layer()
+    trail.remove( band.At('bandit_A', 'junction') )
+    trail.append( band.At('bandit_A', 'path_a') )
+    print(trail.check_fact(band.At('bandit_A', 'path_a'))) # True
+    print(trail.fluent_delta()) 
+    trail.pop_layer()
+    print(trail.check_fact(band.At('bandit_A', 'path_a'))) # False
+    print(trail.state_hash == test_k.state_hash) # True
+
+    # and search runs on either
+    b = band.Bandit('bandit_A')
+    b.set_goal(band.At('bandit_A', 'end'))
+    for knowledge in (test_k, trail):
+        s = search.SearchPlan(knowledge, b)
+        print(f"{type(knowledge).__name__}: {len(s.plan())} steps, generated {s.dc_count} states")
+
+    # a snapshot shares the trail, but undoes its own layers
+    trail.push_layer()
+    trail.remove( band.At('bandit_A', 'junction') )
+    trail.append( band.At('bandit_A', 'path_a') )
+    successor = trail.snapshot()
+    trail.pop_layer()
+    successor.pop_layer()
+    print(successor.state_hash == trail.state_hash) # True
+
+    # and workers rebuild a trail's world from its base, as they do a stack's
+    trail.push_layer()
+    trail.append( band.At('bandit_A', 'path_a') )
+    with parallel.ParallelEvaluator(trail, b, workers=2) as evaluator:
+        s = search.SearchPlan(trail, b, strategy=search.SearchPlan.GBFS, evaluator=evaluator)
+        print(f"parallel: {len(s.plan())} steps, {evaluator.evaluations} in workers")
+    print(parallel.plan_batch(trail, [(b, b.goal)] * 2, workers=2))
+
+def test_versioned_memo():
+    test_k = copy.deepcopy(band.k)
+    test_k.append( band.At('bandit_A', 'junction') ) 
+
+    # versions change with the facts, and come back when the layer is popped
+    at = test_k.version(band.Functor.AT)
+    path = test_k.version(band.Functor.PATH)
+    test_k.push_layer()
+    test_k.append( band.At('bandit_A', 'path_a') ) 
+    print(test_k.version(band.Functor.AT) is at) # False
+    print(test_k.version(band.Functor.PATH) is path) # True
+    test_k.pop_layer()
+    print(test_k.version(band.Functor.AT) is at) # True
+
+    # answers are reused until a functor they read changes
+    memo = cog.VersionedMemo()
+    query = cog.Query( (band.Functor.AT, ('bandit_A', cog.Variable())) )
+    locations = memo.bind('locations', query.functors, query.solve)
+    print(locations(test_k)) # [('junction',)]
+    print(locations(test_k.snapshot())) # [('junction',)] a sibling with the same facts
+    test_k.push_layer()
+    test_k.append( band.OpenGate('path_a', 'trigger_a') ) 
+    print(locations(test_k)) # [('junction',)] gates aren't read
+    test_k.append( band.At('bandit_A', 'path_a') ) 
+    print(sorted(locations(test_k))) # [('junction',), ('path_a',)]
+    print(memo.hits, memo.misses) # 2 2
+
+def test_generated_maze():
+    # the same arguments make the same maze, and the same plan
+    maze = mazes.generate_maze(200, gate_density=0.2, seed=7)
+    print(maze)
+    print(len(mazes.path_to_goal(maze)) - 1 == maze.parameters['goal_distance']) # True
+
+    plans = []
+    for _ in range(2):
+        maze = mazes.generate_maze(200, gate_density=0.2, seed=7)
+        s = search.SearchPlan(maze.knowledge, maze.bandit(), rpg=heu.CountingRelaxedPlanningGraph)
+        plans.append([str(action) for action in s.plan()])
+        print(f"{len(plans[-1])} steps, generated {s.dc_count} states, {s.evaluation_count} evaluations")
+    print(plans[0] == plans[1]) # True
+
+    # facts of a maze that's gone are let go, and hash the same if it's built again
+    state_hash = maze.knowledge.state_hash
+    facts = len(cog.FACT_TABLE)
+    del maze, s
+    gc.collect()
+    print(len(cog.FACT_TABLE) < facts) # True
+    maze = mazes.generate_maze(200, gate_density=0.2, seed=7)
+    print(maze.knowledge.state_hash == state_hash) # True
+
+def test_instrumentation():
+    b = band.Bandit('bandit_A')
+    b.set_goal(band.At('bandit_A', 'end'))
+
+    test_k = copy.deepcopy(band.k)
+    test_k.append( band.At('bandit_A', 'start') ) 
+
+    # off by default, the report only has the search's own numbers
+    plan, report = search.SearchPlan(test_k, b).plan_with_report()
+    print(report)
+
+    # on, it counts and times the hot paths too
+    with instrumentation.recording() as recorder:
+        plan, report = search.SearchPlan(test_k, b, rpg=heu.CountingRelaxedPlanningGraph).plan_with_report()
+    print(report)
+    print(recorder.counts == report.calls) # True
+    print(instrumentation.is_enabled()) # False
+
+def test_trace():
+    b = band.Bandit('bandit_A')
+    b.set_goal(band.At('bandit_A', 'end'))
+
+    test_k = copy.deepcopy(band.k)
+    test_k.append( band.At('bandit_A', 'start') ) 
 
+    # open the file in chrome://tracing or ui.perfetto.dev
+    path = os.path.join(tempfile.gettempdir(), 'cognate_trace.json')
+    with tracing.ChromeTracer(path) as tracer:
+        s = search.SearchPlan(test_k, b, tracer=tracer)
+        print(f"{len(s.plan())} steps, generated {s.dc_count} states")
 
+    with open(path) as f:
+        events = json.load(f)
+    print(path)
+    print(sum(1 for event in events if event['name'] == 'expand') == s.expansions) # True
+    print(sorted(set(event['name'] for event in events if event['ph'] == 'X')))
 
 
+#if __name__ == "__main__" : test_knowledge_layers() 
 #if __name__ == "__main__" : test_trigger() 
 #if __name__ == "__main__" : test_move_action() 
 #if __name__ == "__main__" : test_relaxed_planning_graph() 
+#if __name__ == "__main__" : test_counting_relaxed_planning_graph() 
 #if __name__ == "__main__" : test_search_easy() 
+#if __name__ == "__main__" : test_search_replan() 
+#if __name__ == "__main__" : test_search_best_first() 
+#if __name__ == "__main__" : test_search_step() 
+#if __name__ == "__main__" : test_search_parallel() 
+#if __name__ == "__main__" : test_plan_batch() 
+#if __name__ == "__main__" : test_shared_static() 
+#if __name__ == "__main__" : test_trail_knowledge() 
+#if __name__ == "__main__" : test_query() 
+#if __name__ == "__main__" : test_compiled_rule() 
+#if __name__ == "__main__" : test_versioned_memo() 
+#if __name__ == "__main__" : test_generated_maze() 
+#if __name__ == "__main__" : test_instrumentation() 
+#if __name__ == "__main__" : test_trace() 
 if __name__ == "__main__" : test_search_hard() 
 
 
@@ -0,0 +1,191 @@
+import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
+import cognate.knowledge as cog
+import cognate.heuristic as heu
+import cognate.search as search
+
+
+# What a worker process holds for the life of the pool: the world as it was when the
+# pool was made, and the agent and heuristic engine to run against it.
+_worker_root = None
+_worker_agent = None
+_worker_rpg = None
+# agents planned for by this worker, by name, so they keep their compiled tasks between plans
+_worker_agents = {}
+
+
+def _start_worker(symbol_names: list, payload: bytes) -> None:
+    """ Pool initializer. Runs once per worker process.
+    The symbol table has to be loaded before anything is unpickled:
+    facts encode their arguments as they are interned, and the stores we receive
+    are already encoded with the codes of the parent process.
+    """
+    global _worker_root, _worker_agent, _worker_rpg
+    cog.SYMBOLS.load(symbol_names)
+    static_functors, static, base, (adds, deletes), agent, rpg = pickle.loads(payload)
+
+    root = cog.KnowledgeStack(static_functors)
+    root.static = static
+    root.base = base
+    # Versions are stamped by append, which the stores we were sent never went through.
+    # Unstamped, their functors would pass for empty to a VersionedMemo.
+    for functor in set(static.facts) | set(base.facts):
+        root.versions[functor] = cog.new_version()
+    if adds or deletes:
+        root.push_layer()
+        for add in adds:
+            root.append(add)
+        for delete in deletes:
+            root.remove(delete)
+    _worker_root = root
+    _worker_agent = agent
+    _worker_rpg = rpg
+
+
+def _evaluate(task: tuple) -> tuple:
+    """ Rebuild a state from its fluent delta on top of the worker's world and evaluate it. """
+    goal, adds, deletes = task
+    _worker_agent.set_goal(goal)
+
+    knowledge = _worker_root.snapshot()
+    knowledge.push_layer()
+    for add in adds:
+        knowledge.append(add)
+    for delete in deletes:
+        knowledge.remove(delete)
+    return _worker_rpg(knowledge, _worker_agent).generate_heuristic()
+
+
+def _plan(task: tuple) -> tuple:
+    """ Plan for one agent on the worker's world. """
+    agent, goal, options = task
+    agent = _worker_agents.setdefault(agent.name, agent)
+    agent.set_goal(goal)
+
+    start = time.perf_counter()
+    s = search.SearchPlan(_worker_root.snapshot(), agent, rpg=_worker_rpg, **options)
+    plan = s.plan()
+    return plan, s.dc_count, s.evaluation_count, time.perf_counter() - start
+
+
+def _start_pool(knowledge: cog.KnowledgeStack, agent, rpg, workers: int, layered: bool=False) -> ProcessPoolExecutor:
+    """ A pool whose workers all hold the world of knowledge. With layered, the facts of
+    knowledge's pushed layers are part of that world. Otherwise the workers hold just the
+    base, and states are sent as deltas against it.
+    """
+    delta = knowledge.fluent_delta() if layered else ([], [])
+    payload = pickle.dumps((knowledge.static_functors, knowledge.static, knowledge.base, delta, agent, rpg))
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_start_worker,
+        initargs=(list(cog.SYMBOLS.names), payload)
+    )
+
+
+class ParallelEvaluator:
+    """ Evaluates heuristics for batches of states on a pool of worker processes.
+    The static facts and the base fluents of knowledge are sent to each worker once,
+    when the pool starts. After that a state only costs the fluent facts it adds
+    and deletes relative to that base, which is a handful for a successor.
+    Results come back in the order the states were given, whatever the workers do.
+
+    Pass it to SearchPlan(evaluator=...). States must share knowledge's static store.
+    knowledge can be a KnowledgeStack or a TrailKnowledge, the workers hold a stack either way.
+    Use it as a context manager, or call close(), to shut the workers down.
+    """
+    def __init__(self, knowledge: cog.KnowledgeStack, agent, rpg=heu.RelaxedPlanningGraph, workers: int=None):
+        self.static = knowledge.static
+        self.base = knowledge.base
+        # what the workers evaluate with, SearchPlan checks it's planning with the same
+        self.agent_name = agent.name
+        self.rpg = rpg
+        self.workers = workers or os.cpu_count() or 1
+
+        self.executor = _start_pool(knowledge, agent, rpg, self.workers)
+        # how many states were sent to the workers
+        self.evaluations = 0
+
+    def evaluate(self, states: list) -> list:
+        """ (heuristic, helpful actions) for each state, in order. """
+        tasks = []
+        for state in states:
+            if state.knowledge.static is not self.static:
+                raise ValueError("state belongs to a different world than the evaluator")
+            adds, deletes = state.knowledge.fluent_delta(self.base)
+            tasks.append((state.agent.goal, adds, deletes))
+        self.evaluations += len(tasks)
+
+        # a few chunks per worker keeps them all busy without paying a round trip per state
+        chunksize = max(1, len(tasks) // (self.workers * 4))
+        return list(self.executor.map(_evaluate, tasks, chunksize=chunksize))
+
+    def close(self) -> None:
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class BatchReport:
+    """ Result of plan_batch: a plan per request, in request order, and how fast they came. """
+    def __init__(self, plans: list, dc_counts: list, evaluations: list, plan_times: list, 
+                 elapsed: float, workers: int):
+        # None for requests with no plan
+        self.plans = plans
+        self.dc_counts = dc_counts
+        self.evaluations = evaluations
+        # seconds each plan took in its worker
+        self.plan_times = plan_times
+
+        # wall time for the batch, pool startup included
+        self.elapsed = elapsed
+        self.workers = workers
+
+    @property
+    def solved(self) -> int:
+        return sum(1 for plan in self.plans if plan is not None)
+
+    @property
+    def plans_per_second(self) -> float:
+        return len(self.plans) / self.elapsed if self.elapsed > 0 else 0.0
+
+    @property
+    def plans_per_second_per_core(self) -> float:
+        return self.plans_per_second / self.workers
+
+    def __repr__(self):
+        return (f"BatchReport: {self.solved}/{len(self.plans)} solved in {self.elapsed:.3f}s on {self.workers} workers, "
+                f"{self.plans_per_second:.1f} plans/s, {self.plans_per_second_per_core:.1f} plans/s/core, "
+                f"{sum(self.dc_counts)} states generated, {sum(self.evaluations)} evaluations")
+
+
+def plan_batch(knowledge: cog.KnowledgeStack, requests: list, rpg=heu.RelaxedPlanningGraph, 
+               workers: int=None, **search_options) -> BatchReport:
+    """ Plan for many agents sharing one world, spread over worker processes.
+    requests is a list of (agent, goal) pairs. Every agent plans from knowledge as it is,
+    which should hold each agent's starting position. The world goes to each worker
+    once; after that a request only costs its agent and goal.
+    search_options are passed on to SearchPlan, eg strategy or lazy.
+    """
+    workers = workers or os.cpu_count() or 1
+    start = time.perf_counter()
+
+    tasks = [(agent, goal, search_options) for agent, goal in requests]
+    with _start_pool(knowledge, None, rpg, workers, layered=True) as executor:
+        # plans vary a lot in cost, so hand them out one at a time
+        results = list(executor.map(_plan, tasks))
+
+    plans = [result[0] for result in results]
+    return BatchReport(
+        plans,
+        [result[1] for result in results],
+        [result[2] for result in results],
+        [result[3] for result in results],
+        time.perf_counter() - start,
+        workers
+    )
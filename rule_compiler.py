@@ -0,0 +1,215 @@
+from typing import List, Tuple
+import cognate.knowledge as cog
+
+
+class Not:
+    """ Holds when the fact is not known. Its variables must be bound by the positive atoms. """
+    def __init__(self, functor, arguments: Tuple):
+        self.functor = functor
+        self.arguments = arguments
+
+
+class AnyOf:
+    """ Holds when one of the alternatives does. Each alternative is a list of atoms and Nots,
+    tested in order, over variables bound by the positive atoms. The index of the alternative
+    that held comes out with each solution, so callers know which facts it relied on.
+    """
+    def __init__(self, *alternatives):
+        self.alternatives = [list(alternative) for alternative in alternatives]
+
+
+class CompiledRule:
+    """ A rule compiled to a python function that joins straight out of the knowledge indexes.
+
+    The rule is a list of conditions: atoms (functor, arguments) as in Query, Nots and AnyOfs.
+    Arguments are names or Variables. Variables listed in parameters are given a value by
+    bind(), the others are solved for. The atoms are joined in a fixed order, decided here:
+    the one with the most bound arguments next, and each Not or AnyOf is tested as soon as
+    its variables are bound.
+
+    bind(*values) returns a function of knowledge that lists the solutions as tuples of
+    symbol codes, one per solved variable in order of first appearance, followed by the
+    alternative taken for each AnyOf. It creates no Proposals, Variables or Facts.
+    """
+    def __init__(self, conditions: List, parameters: Tuple=()):
+        self.parameters = list(parameters)
+        self.variables = []
+        self.functors = []
+        self.constants = []
+
+        atoms = []
+        tests = []
+        for condition in conditions:
+            if isinstance(condition, (Not, AnyOf)):
+                tests.append(condition)
+            else:
+                atoms.append(condition)
+                for argument in condition[1]:
+                    if (isinstance(argument, cog.Variable) and argument not in self.parameters
+                            and argument not in self.variables):
+                        self.variables.append(argument)
+        self.groups = sum(1 for test in tests if isinstance(test, AnyOf))
+
+        self.lines = []
+        self.sets = {}
+        self.bound = set(self.parameters)
+        self._generate(atoms, tests)
+
+        functor_names = [f"F{i}" for i in range(len(self.functors))]
+        constant_names = [f"C{i}" for i in range(len(self.constants))]
+        parameter_names = [f"P{i}" for i in range(len(self.parameters))]
+        header = [
+            f"def make({', '.join(functor_names + constant_names + parameter_names)}):",
+            "    def rule(knowledge):",
+            "        lookup = knowledge.lookup",
+        ]
+        header += [f"        {name} = knowledge.flatten({functor})" for functor, name in self.sets.items()]
+        header.append("        solutions = []")
+        self.source = "\n".join(header + self.lines + ["        return solutions", "    return rule", ""])
+
+        namespace = {}
+        exec(compile(self.source, "<compiled rule>", "exec"), namespace)
+        self.factory = namespace['make']
+
+    def bind(self, *values):
+        """ The rule for these parameter values, as a function of knowledge. """
+        if len(values) != len(self.parameters):
+            raise ValueError(f"rule takes {len(self.parameters)} parameters, got {len(values)}")
+        codes = [cog.SYMBOLS.encode_symbol(value) for value in values]
+        return self.factory(*self.functors, *self.constants, *codes)
+
+    def solve(self, knowledge, *values) -> List[Tuple]:
+        """ Solutions as names, for checking a rule by hand. """
+        names = cog.SYMBOLS.names
+        count = len(self.variables)
+        return [tuple(names[code] for code in solution[:count]) + solution[count:]
+                for solution in self.bind(*values)(knowledge)]
+
+    # code generation
+
+    def _functor(self, functor) -> str:
+        if functor not in self.functors:
+            self.functors.append(functor)
+        return f"F{self.functors.index(functor)}"
+
+    def _set(self, functor) -> str:
+        """ Name of the flattened set of functor, read once per call. """
+        name = self._functor(functor)
+        if name not in self.sets:
+            self.sets[name] = f"S{len(self.sets)}"
+        return self.sets[name]
+
+    def _term(self, argument) -> str:
+        if isinstance(argument, cog.Variable):
+            if argument in self.parameters:
+                return f"P{self.parameters.index(argument)}"
+            return f"V{self.variables.index(argument)}"
+        # the rule outlives this call, so the symbol has to exist for later worlds
+        code = cog.SYMBOLS.encode_symbol(argument)
+        if code not in self.constants:
+            self.constants.append(code)
+        return f"C{self.constants.index(code)}"
+
+    def _is_bound(self, argument) -> bool:
+        return not isinstance(argument, cog.Variable) or argument in self.bound
+
+    def _tuple(self, arguments: Tuple) -> str:
+        terms = [self._term(argument) for argument in arguments]
+        return f"({terms[0]},)" if len(terms) == 1 else f"({', '.join(terms)})"
+
+    def _membership(self, condition) -> str:
+        if isinstance(condition, Not):
+            functor, arguments, negated = condition.functor, condition.arguments, True
+        else:
+            (functor, arguments), negated = condition, False
+        if not all(self._is_bound(argument) for argument in arguments):
+            raise ValueError(f"variables of {functor} must be bound by the atoms before it")
+        return f"{self._tuple(arguments)} {'not in' if negated else 'in'} {self._set(functor)}"
+
+    def _ready(self, test) -> bool:
+        if isinstance(test, Not):
+            conditions = [test]
+        else:
+            conditions = [condition for alternative in test.alternatives for condition in alternative]
+        for condition in conditions:
+            arguments = condition.arguments if isinstance(condition, Not) else condition[1]
+            if not all(self._is_bound(argument) for argument in arguments):
+                return False
+        return True
+
+    def _generate(self, atoms: List, tests: List) -> None:
+        indent = 2
+        group = 0
+        atoms = list(atoms)
+        tests = list(tests)
+        while True:
+            # atoms with every argument bound are only membership tests, cheaper than the rest
+            for atom in [atom for atom in atoms if all(self._is_bound(argument) for argument in atom[1])]:
+                atoms.remove(atom)
+                indent = self._join(atom, indent)
+
+            # tests go as early as they can, they prune the joins below them
+            for test in [test for test in tests if self._ready(test)]:
+                tests.remove(test)
+                pad = "    " * indent
+                if isinstance(test, Not):
+                    self.lines.append(f"{pad}if {self._membership(test)}:")
+                else:
+                    name = f"G{group}"
+                    group += 1
+                    self.lines.append(f"{pad}{name} = -1")
+                    for index, alternative in enumerate(test.alternatives):
+                        condition = " and ".join(self._membership(c) for c in alternative) or "True"
+                        keyword = "if" if index == 0 else "elif"
+                        self.lines.append(f"{pad}{keyword} {condition}:")
+                        self.lines.append(f"{pad}    {name} = {index}")
+                    self.lines.append(f"{pad}if {name} >= 0:")
+                indent += 1
+
+            if not atoms:
+                break
+
+            # the most constrained atom next
+            atom = max(atoms, key=lambda atom: sum(1 for argument in atom[1] if self._is_bound(argument)))
+            atoms.remove(atom)
+            indent = self._join(atom, indent)
+
+        if tests:
+            raise ValueError("some variables of the rule's tests are never bound")
+        solution = [f"V{i}" for i in range(len(self.variables))] + [f"G{i}" for i in range(group)]
+        self.lines.append(f"{'    ' * indent}solutions.append(({', '.join(solution)}{',' if len(solution) == 1 else ''}))")
+
+    def _join(self, atom, indent: int) -> int:
+        functor, arguments = atom
+        pad = "    " * indent
+        bound = [position for position, argument in enumerate(arguments) if self._is_bound(argument)]
+
+        if len(bound) == len(arguments):
+            self.lines.append(f"{pad}if {self._membership(atom)}:")
+            return indent + 1
+
+        row = f"R{indent}"
+        if bound:
+            # look up by a fixed value if there is one, those tend to be the most selective
+            constants = [position for position in bound if not isinstance(arguments[position], cog.Variable)
+                         or arguments[position] in self.parameters]
+            key = constants[0] if constants else bound[0]
+            self.lines.append(f"{pad}for {row} in lookup({self._functor(functor)}, {key}, {self._term(arguments[key])}):")
+        else:
+            key = None
+            self.lines.append(f"{pad}for {row} in {self._set(functor)}:")
+        pad += "    "
+
+        # check the other fixed arguments, bind the free ones, check repeats
+        for position, argument in enumerate(arguments):
+            if position == key:
+                continue
+            if position in bound:
+                self.lines.append(f"{pad}if {row}[{position}] != {self._term(argument)}: continue")
+            elif argument in self.bound:
+                # a variable seen earlier in this same atom
+                self.lines.append(f"{pad}if {row}[{position}] != {self._term(argument)}: continue")
+            else:
+                self.lines.append(f"{pad}{self._term(argument)} = {row}[{position}]")
+                self.bound.add(argument)
+        return indent + 1
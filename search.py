@@ -1,45 +1,208 @@
-import copy
+import heapq
+import itertools
+import time
+from collections import deque
 import cognate.heuristic as heu
+import cognate.instrumentation as instrumentation
+import cognate.tracing as tracing
 
 
-class State:
-    def __init__(self, knowledge, agent, action=None):
+class ClosedSet:
+    """ Zobrist hashes of every state the search has generated. """
+    def __init__(self):
+        self.hashes = set()
+        # how many generated states were dropped because they had been seen before
+        self.duplicates = 0
+
+    def visit(self, state_hash: int) -> bool:
+        """ Record a state. Returns False if it had already been visited. """
+        if state_hash in self.hashes:
+            self.duplicates += 1
+            return False
+        self.hashes.add(state_hash)
+        return True
+
+    def clear(self) -> None:
+        """ Forget the visited states, but keep counting duplicates. """
+        self.hashes.clear()
+
+
+class SearchContext:
+    """ What every state of one search shares: the agent, the heuristic engine and its
+    cache, the closed set and the evaluation count.
+    evaluator, if given, evaluates batches of successors in other processes 
+    (see parallel.ParallelEvaluator).
+    """
+    def __init__(self, agent, rpg=heu.RelaxedPlanningGraph, cache: heu.HeuristicCache=None, evaluator=None):
         self.agent = agent
+        self.rpg = rpg
+        self.cache = cache
+        self.evaluator = evaluator
+        self.closed = ClosedSet()
+
+        # how many times the heuristic engine actually ran
+        self.evaluations = 0
+        # the evaluated state with the lowest heuristic so far, for partial plans
+        self.best_state = None
+        # tracing.SearchTrace, when the search is traced
+        self.trace = None
+
+    def note_evaluated(self, state: 'State') -> None:
+        if self.best_state is None or state.heuristic < self.best_state.heuristic:
+            self.best_state = state
+
+    def evaluate_all(self, states: list) -> None:
+        """ Evaluate a batch of states. Cached states are resolved here, the rest go to
+        the evaluator if there is one and enough of them to be worth the round trip.
+        """
+        pending = [state for state in states if not state.evaluated and not state.lookup()]
+        if self.evaluator is None or len(pending) < 2:
+            # already looked up, a second lookup would count each miss twice
+            for state in pending:
+                state.run_heuristic()
+            return
+
+        if self.trace is not None:
+            start = self.trace.tracer.now()
+
+        for state, (heuristic, actions) in zip(pending, self.evaluator.evaluate(pending)):
+            state.record(heuristic, actions)
+        if self.trace is not None:
+            self.trace.tracer.complete("evaluate batch", self.trace.search, start,
+                                       {"states": len(pending)}, category='heuristic')
+
+
+class State:
+    def __init__(self, knowledge, context: SearchContext, action=None, parent: 'State'=None, 
+                 evaluate: bool=True):
+        self.context = context
+        self.agent = context.agent
+
+        # the plan is recovered by following parents back to the initial state
+        self.parent = parent
+        self.depth = 0 if parent is None else parent.depth + 1
         
-        # This will lead to performance issues I think.
-        # We'll need to architect knowledge in such a way as to minimize the impact of this sort of copy.
-        # perhaps all facts can be maintained as singletons in a big hashtable?
-        # Previously I think I had a 'clone' function to do this.
-        # regardless, we'll want to measure how much allocation we're doing....
-        self.knowledge = copy.deepcopy(knowledge)
+        # A snapshot shares the base facts and all of the parent's layers,
+        # so a successor only costs the delta that produced it.
+        # See benchmarks/knowledge_memory_benchmark.py for the allocation numbers.
+        self.knowledge = knowledge.snapshot()
+        self.fingerprint = self.knowledge.state_hash
         
         # action is what effected this state. Nonne signifies that it is initial conditions
         self.action = action
 
-        # we immediately generate heuristic for this state and helpful actions
-        rpg = heu.RelaxedPlanningGraph(self.knowledge, self.agent)
-        self.heuristic, self.actions = rpg.generate_heuristic()
+        # Unevaluated states borrow their parent's heuristic as an estimate 
+        # until evaluate() is called. Their helpful actions are unknown until then.
+        self.evaluated = False
+        self.heuristic = heu.DEAD_END if parent is None else parent.heuristic
+        self.actions = None
+        if evaluate:
+            self.evaluate()
+
+    def evaluate(self) -> None:
+        """ Generate heuristic for this state and helpful actions,
+        unless an identical state has been evaluated before
+        """
+        if self.evaluated or self.lookup():
+            return
+        self.run_heuristic()
+
+    def run_heuristic(self) -> None:
+        """ Evaluate with the heuristic engine, for states already looked up in the cache. """
+        rpg = self.context.rpg(self.knowledge, self.agent)
+        trace = self.context.trace
+        if trace is None:
+            self.record(*rpg.generate_heuristic())
+            return
+        start = trace.tracer.now()
+        heuristic, actions = rpg.generate_heuristic()
+        trace.evaluated(self, start, heuristic, len(actions))
+        self.record(heuristic, actions)
+
+    def lookup(self) -> bool:
+        """ Take the heuristic from the cache if an identical state has been evaluated before. """
+        cache = self.context.cache
+        if cache is None:
+            return False
+        cached = cache.get(self.cache_key())
+        if cached is None:
+            return False
+        self.evaluated = True
+        self.heuristic, self.actions = cached
+        self.context.note_evaluated(self)
+        return True
+
+    def cache_key(self) -> tuple:
+        return self.context.cache.make_key(self.agent, self.context.rpg, self.knowledge.static, self.fingerprint)
+
+    def record(self, heuristic: int, actions) -> None:
+        """ Store the outcome of running the heuristic engine on this state, wherever it ran. """
+        self.evaluated = True
+        self.heuristic, self.actions = heuristic, actions
+        self.context.evaluations += 1
+        self.context.note_evaluated(self)
+
+        cache = self.context.cache
+        if cache is not None:
+            cache.put(self.cache_key(), (heuristic, actions))
+
+    def extract_plan(self) -> list:
+        """ The actions that lead from the initial state to this one. """
+        plan = []
+        state = self
+        while state.parent is not None:
+            plan.append(state.action)
+            state = state.parent
+        plan.reverse()
+        return plan
+
+    def get_successors(self, helpful_only: bool=True, lazy: bool=False):
+        """ generate successor states from each helpful action, 
+        skipping any state already in the closed set.
+        With helpful_only False every applicable action is tried, which keeps search complete.
+        With lazy the successors are PendingStates, in action order, for the caller to build
+        and evaluate as it gets to them. Otherwise they are evaluated and sorted best first.
+        """
+        self.evaluate()
+        if helpful_only:
+            actions = self.actions
+        else:
+            actions = self.agent.produce_valid_actions(self.knowledge)
 
-    def get_successors(self):
-        """ generate successor states from each helpful action """
         successors = []
-        for action in self.actions:
+        for action in actions:
             if action.meets_preconditions(self.knowledge):
                 adds = action.generate_add_list(self.knowledge)
                 deletes = action.generate_delete_list(self.knowledge)
                 
                 if self.is_taboo(action):
                     continue
-                
-                self.knowledge.push_layer()
-                for add in adds:
-                    self.knowledge.append(add)
-                for delete in deletes:
-                    self.knowledge.remove(delete)
-                successors.append(State(self.knowledge, self.agent, action))
-                self.knowledge.pop_layer()
 
+                if lazy:
+                    successors.append(PendingState(self, action, adds, deletes))
+                    continue
+                successor = self.successor(action, adds, deletes)
+                if successor is not None:
+                    successors.append(successor)
+
+        if lazy:
+            return successors
+        self.context.evaluate_all(successors)
         return sorted(successors, key=lambda s: s.heuristic)
+
+    def successor(self, action, adds, deletes) -> 'State':
+        """ The unevaluated state that action leads to, or None if it is in the closed set. """
+        self.knowledge.push_layer()
+        for add in adds:
+            self.knowledge.append(add)
+        for delete in deletes:
+            self.knowledge.remove(delete)
+        # check before building the state, that's where the RPG cost is
+        successor = None
+        if self.context.closed.visit(self.knowledge.state_hash):
+            successor = State(self.knowledge, self.context, action, self, evaluate=False)
+        self.knowledge.pop_layer()
+        return successor
     
     def is_taboo(self, successor):
         """ A successor is taboo if it precisely reverses the action that got us to
@@ -49,42 +212,380 @@ class State:
             return False
         return self.action.add_list == successor.delete_list and self.action.delete_list == successor.add_list       
 
+class PendingState:
+    """ A successor generated by a lazy search but not built yet: the parent and the action
+    that lead to it. It waits on the open list with its parent's heuristic, and only
+    costs a layer, a snapshot and an evaluation if the search gets to it.
+    """
+    __slots__ = ('parent', 'action', 'adds', 'deletes', 'depth', 'heuristic')
+
+    def __init__(self, parent: State, action, adds, deletes):
+        self.parent = parent
+        self.action = action
+        self.adds = adds
+        self.deletes = deletes
+        self.depth = parent.depth + 1
+        self.heuristic = parent.heuristic
+
+    def build(self) -> State:
+        """ The unevaluated state, or None if the search has generated it since. """
+        return self.parent.successor(self.action, self.adds, self.deletes)
+
+
+def built(state) -> State:
+    """ state, built first if it's pending. None if it turned out to be a duplicate. """
+    if isinstance(state, PendingState):
+        return state.build()
+    return state
+
+
+class SearchProgress:
+    """ Report from SearchPlan.step(): what the call did and where the search stands. """
+    RUNNING = 'running'
+    SOLVED = 'solved'
+    FAILED = 'failed'
+
+    def __init__(self, status: str, plan: list, best_heuristic: int, expansions: int, generated: int,
+                 evaluations: int, duplicates: int, elapsed_us: int, dc_count: int):
+        self.status = status
+        # the plan once solved. Otherwise the path to the state with the lowest heuristic
+        # found so far, which an agent can start following while the search goes on.
+        self.plan = plan
+        self.best_heuristic = best_heuristic
+
+        # work done by this call
+        self.expansions = expansions
+        self.generated = generated
+        self.evaluations = evaluations
+        self.duplicates = duplicates
+        self.elapsed_us = elapsed_us
+
+        # states generated since the search began
+        self.dc_count = dc_count
+
+    @property
+    def finished(self) -> bool:
+        return self.status != SearchProgress.RUNNING
+
+    def __repr__(self):
+        return (f"SearchProgress {self.status}: {len(self.plan or [])} steps, best heuristic {self.best_heuristic}, "
+                f"{self.expansions} expansions, {self.generated} generated, {self.evaluations} evaluations, "
+                f"{self.duplicates} duplicates in {self.elapsed_us}us")
+
+
+class PlanReport:
+    """ What a plan cost, from SearchPlan.report() or plan_with_report(). Calls and seconds 
+    per hot path method are only there for the steps run while instrumentation was enabled,
+    see instrumentation.enable(). Heuristics evaluated by a ParallelEvaluator aren't in them.
+    """
+    def __init__(self, status: str, plan_length: int, elapsed: float, dc_count: int, expansions: int,
+                 evaluations: int, duplicates: int, fell_back: bool, recorder: instrumentation.Recorder):
+        self.status = status
+        self.plan_length = plan_length
+        # seconds spent in step(), which excludes time between steps
+        self.elapsed = elapsed
+        self.dc_count = dc_count
+        self.expansions = expansions
+        self.evaluations = evaluations
+        self.duplicates = duplicates
+        self.fell_back = fell_back
+
+        self.calls = dict(recorder.counts)
+        self.seconds = {name: ns / 1e9 for name, ns in recorder.times.items()}
+
+    def as_dict(self) -> dict:
+        """ Plain values, for telemetry. """
+        return dict(self.__dict__)
+
+    def __repr__(self):
+        lines = [f"PlanReport {self.status}: {self.plan_length} steps in {self.elapsed*1000:.3f} ms, "
+                 f"{self.expansions} expansions, {self.dc_count} generated, {self.evaluations} evaluations, "
+                 f"{self.duplicates} duplicates{', fell back' if self.fell_back else ''}"]
+        for name, calls in sorted(self.calls.items(), key=lambda item: -self.seconds.get(item[0], 0)):
+            lines.append(f"{name:>50}: {calls:>9} calls {self.seconds.get(name, 0)*1000:10.3f} ms")
+        return "\n".join(lines)
+
+
 class SearchPlan:
-    def __init__(self, knowledge, agent):
-        self.curr_state = State(knowledge, agent)
+    # search strategies
+    EHC = 'ehc'            # Enforced Hill Climbing, falling back to GBFS if it gets stuck
+    GBFS = 'gbfs'          # greedy best first: lowest heuristic first
+    WEIGHTED_A_STAR = 'wastar' # lowest depth + weight * heuristic first
+
+    def __init__(self, knowledge, agent, cache: heu.HeuristicCache=None, rpg=heu.RelaxedPlanningGraph,
+                 strategy: str=EHC, weight: float=2.0, lazy: bool=False, evaluator=None,
+                 tracer: tracing.ChromeTracer=None):
+        """ Pass the same cache to successive plans for an agent to reuse heuristics. 
+        rpg is the heuristic engine: RelaxedPlanningGraph works with any agent,
+        CountingRelaxedPlanningGraph needs an agent that can compile its task.
+        weight only matters for WEIGHTED_A_STAR.
+        lazy defers building and evaluating each successor until the search gets to it.
+        evaluator spreads the evaluation of each batch of successors over worker processes,
+        eg a parallel.ParallelEvaluator built for this world, agent and rpg. 
+        It has no effect on lazy searches, which evaluate one state at a time.
+        tracer, a tracing.ChromeTracer, records the search as it goes.
+        """
+        if evaluator is not None:
+            # the workers' heuristics would be mixed with ours, and cached as ours
+            if evaluator.rpg is not rpg:
+                raise ValueError(f"evaluator runs {evaluator.rpg.__name__}, the plan {rpg.__name__}")
+            if evaluator.agent_name != agent.name:
+                raise ValueError(f"evaluator evaluates for {evaluator.agent_name}, not {agent.name}")
+        self.context = SearchContext(agent, rpg, cache, evaluator)
+        if tracer is not None:
+            self.context.trace = tracing.SearchTrace(tracer, agent.name)
+        # the initial state is evaluated by the first step, inside its budget
+        self.curr_state = State(knowledge, self.context, evaluate=False)
         self.dc_count = 0
+        self.expansions = 0
+
+        self.strategy = strategy
+        self.weight = weight
+        self.lazy = lazy
+        # set when EHC failed and best first search took over
+        self.fell_back = False
+
+        self.closed = self.context.closed
+        self.closed.visit(self.curr_state.fingerprint)
+
+        # the running search, resumed by each step
+        self.search = None
+        self.finished = False
+        self.result = None
+
+        # for report(): time spent in step(), and the hot path calls it made
+        self.elapsed_ns = 0
+        self.recorder = instrumentation.Recorder()
+
+    @property
+    def duplicate_count(self) -> int:
+        """ Generated states pruned because they were already seen. """
+        return self.closed.duplicates
+
+    @property
+    def evaluation_count(self) -> int:
+        """ Heuristic evaluations run, the main cost of planning. """
+        return self.context.evaluations
 
     def plan(self):
+        """ Search to the end. Returns the list of actions, or None if there is no plan. """
+        while not self.step().finished:
+            pass
+        return self.result
+
+    def status(self) -> str:
+        if not self.finished:
+            return SearchProgress.RUNNING
+        if self.result is None:
+            return SearchProgress.FAILED
+        return SearchProgress.SOLVED
+
+    def plan_with_report(self) -> tuple:
+        """ plan(), and the PlanReport of what it cost. """
+        plan = self.plan()
+        return plan, self.report()
+
+    def report(self) -> PlanReport:
+        """ What the search has cost so far. """
+        return PlanReport(self.status(), len(self.result) if self.result is not None else None, self.elapsed_ns / 1e9,
+                          self.dc_count, self.expansions, self.evaluation_count, self.duplicate_count,
+                          self.fell_back, self.recorder)
+
+    def step(self, max_expansions: int=None, max_time_us: int=None) -> SearchProgress:
+        """ Search for at most max_expansions state expansions or max_time_us microseconds,
+        then return, to be resumed by the next call. The time budget is checked between 
+        expansions, so a call can overrun it by one expansion.
+        """
+        start = time.perf_counter_ns()
+        expansions = self.expansions
+        dc_count = self.dc_count
+        evaluations = self.evaluation_count
+        duplicates = self.duplicate_count
+
+        if self.search is None:
+            self.search = self.run()
+
+        # count this step's calls apart, for this plan's report, then pass them on to
+        # whoever was counting before, so that an enclosing recording sees them too
+        recorder = None
+        if instrumentation.is_enabled():
+            instrumentation.instrument_agent(self.context.agent)
+            recorder = instrumentation.Recorder()
+            outer = instrumentation.activate(recorder)
+        try:
+            while not self.finished:
+                if max_expansions is not None and self.expansions - expansions >= max_expansions:
+                    break
+                if max_time_us is not None and (time.perf_counter_ns() - start) // 1000 >= max_time_us:
+                    break
+                try:
+                    next(self.search)
+                except StopIteration as done:
+                    self.finished = True
+                    self.result = done.value
+        finally:
+            if recorder is not None:
+                instrumentation.activate(outer)
+                self.recorder.merge(recorder)
+                outer.merge(recorder)
+
+        status = self.status()
+
+        best_state = self.context.best_state
+        if status == SearchProgress.SOLVED:
+            plan = self.result
+            best_heuristic = 0
+        elif best_state is not None:
+            plan = best_state.extract_plan()
+            best_heuristic = best_state.heuristic
+        else:
+            plan = []
+            best_heuristic = heu.DEAD_END
+
+        elapsed_ns = time.perf_counter_ns() - start
+        self.elapsed_ns += elapsed_ns
+        return SearchProgress(
+            status, 
+            plan,
+            best_heuristic,
+            self.expansions - expansions, 
+            self.dc_count - dc_count, 
+            self.evaluation_count - evaluations, 
+            self.duplicate_count - duplicates,
+            elapsed_ns // 1000,
+            self.dc_count
+        )
+
+    def run(self):
+        """ The whole search as a generator that yields after every expansion. 
+        Its return value is the plan.
+        """
+        self.curr_state.evaluate()
+
+        # if even the relaxed problem has no solution, the real one doesn't either
+        if self.curr_state.heuristic >= heu.DEAD_END:
+            return None
+
+        if self.strategy == SearchPlan.EHC:
+            plan = yield from self.traced("enforced hill climbing", self.enforced_hill_climbing())
+            if plan is None:
+                # EHC only follows helpful actions and commits to every improvement,
+                # so it can strand itself. Best first search is complete.
+                self.fell_back = True
+                if self.context.trace is not None:
+                    self.context.trace.tracer.instant("fell back to best first", self.context.trace.search)
+                plan = yield from self.traced("best first gbfs", self.best_first(SearchPlan.GBFS))
+            return plan
+        return (yield from self.traced(f"best first {self.strategy}", self.best_first(self.strategy)))
+
+    def traced(self, name: str, search):
+        """ search, a search generator, as one span on the trace if there is one. """
+        trace = self.context.trace
+        if trace is None:
+            return (yield from search)
+        start = trace.tracer.now()
+        plan = yield from search
+        trace.tracer.complete(name, trace.search, start, {"solved": plan is not None})
+        return plan
+
+    def enforced_hill_climbing(self):
         ''' Enforced Hill Climbing Search of states leading to goal satisfaction.
         '''
-        open_list = [[self.curr_state]]
+        if self.curr_state.heuristic == 0:
+            return []
+
+        trace = self.context.trace
+        open_list = deque([self.curr_state])
         best_heuristic = self.curr_state.heuristic
         while len(open_list):
-            path = open_list.pop(0)
-            curr_state = path[-1]
+            curr_state = built(open_list.popleft())
+            if curr_state is None:
+                continue
+            if trace is not None:
+                start = trace.tracer.now()
             
             # evaluate all state that can be attained from this one.
-            # the states are sort from best to worst
-            successors = curr_state.get_successors()
-            self.dc_count += len(successors)
+            # the states are sort from best to worst.
+            # Lazily, they come in helpful action order and are built and evaluated one at
+            # a time, so the siblings of an improving state are only built if EHC comes back.
+            successors = curr_state.get_successors(lazy=self.lazy)
+            generated = len(successors)
+            self.dc_count += generated
+            self.expansions += 1
+            improved = False
             while len(successors):
-                next_state = successors.pop(0)
+                next_state = built(successors.pop(0))
+                if next_state is None:
+                    continue
+                next_state.evaluate()
                 h = next_state.heuristic
                 if h == 0: # this is a goal state
-                    path.append(next_state)
-                    return [state.action for state in path[1:]]
+                    if trace is not None:
+                        trace.end_plateau("goal", h)
+                        trace.expanded(curr_state, start, generated, len(open_list), h)
+                    return next_state.extract_plan()
                 
                 if h < best_heuristic:
                     # either the first possible state is better than the current
                     # or we're at a local minimum or a plateau. If that's the case,
                     # we'll explore all possibilities.                  
-                    for successor in successors:
-                        new_path = copy.copy(path)
-                        new_path.append(successor)
-                        open_list.append(new_path)    
+                    open_list.extend(successors)
                     successors.clear()
                     best_heuristic = h
-                new_path = copy.copy(path)
-                new_path.append(next_state)
-                open_list.insert(0, new_path)
-        return None
\ No newline at end of file
+                    improved = True
+                    if trace is not None:
+                        trace.improved(h)
+                open_list.appendleft(next_state)
+
+            if trace is not None:
+                if not improved:
+                    trace.on_plateau(best_heuristic)
+                trace.expanded(curr_state, start, generated, len(open_list), best_heuristic)
+            yield
+
+        if trace is not None:
+            trace.end_plateau("stuck")
+        return None
+
+    def priority(self, state: State, strategy: str) -> float:
+        if strategy == SearchPlan.WEIGHTED_A_STAR:
+            return state.depth + self.weight * state.heuristic
+        return state.heuristic
+
+    def best_first(self, strategy: str):
+        ''' Greedy best first or weighted A* search over every applicable action.
+        The open list is a heap, ties go to the state generated first.
+        '''
+        # states EHC already visited must be reachable again
+        self.closed.clear()
+        self.closed.visit(self.curr_state.fingerprint)
+
+        trace = self.context.trace
+        order = itertools.count()
+        open_list = [(self.priority(self.curr_state, strategy), next(order), self.curr_state)]
+        while len(open_list):
+            _, _, curr_state = heapq.heappop(open_list)
+            # lazy successors are queued on their parent's heuristic, built and evaluated here
+            curr_state = built(curr_state)
+            if curr_state is None:
+                continue
+            if trace is not None:
+                start = trace.tracer.now()
+            curr_state.evaluate()
+            if curr_state.heuristic == 0:
+                return curr_state.extract_plan()
+            if curr_state.heuristic >= heu.DEAD_END:
+                continue
+
+            successors = curr_state.get_successors(helpful_only=False, lazy=self.lazy)
+            self.dc_count += len(successors)
+            self.expansions += 1
+            for successor in successors:
+                if successor.heuristic >= heu.DEAD_END:
+                    continue
+                heapq.heappush(open_list, (self.priority(successor, strategy), next(order), successor))
+            if trace is not None:
+                trace.expanded(curr_state, start, len(successors), len(open_list), 
+                               self.context.best_state.heuristic)
+            yield
+        return None
@@ -0,0 +1,248 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from multiprocessing import shared_memory
+from typing import Tuple
+import weakref
+import cognate.knowledge as cog
+
+
+class SharedRelation:
+    """ The encoded argument tuples of one static functor, read straight out of shared memory.
+    The rows are stored once per argument position, each copy sorted on that position,
+    so a fixed argument finds its rows by binary search instead of through a hashed index.
+    Copy 0 is in full tuple order. Behaves enough like a set for flatten and check_fact.
+    """
+    def __init__(self, buffer: memoryview, arity: int, count: int):
+        self.arity = arity
+        self.count = count
+        # one int view per position, and the column that copy is sorted on
+        self.rows = []
+        self.columns = []
+        size = arity * count
+        for position in range(arity):
+            rows = buffer[position*size:(position+1)*size]
+            self.rows.append(rows)
+            self.columns.append(rows[position::arity])
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        rows = self.rows[0]
+        arity = self.arity
+        for start in range(0, self.count * arity, arity):
+            yield tuple(rows[start:start+arity])
+
+    def __contains__(self, arguments: Tuple) -> bool:
+        if len(arguments) != self.arity:
+            return False
+        column = self.columns[0]
+        rows = self.rows[0]
+        first = arguments[0]
+        arity = self.arity
+        for row in range(bisect_left(column, first), bisect_right(column, first)):
+            if tuple(rows[row*arity:(row+1)*arity]) == arguments:
+                return True
+        return False
+
+    def bucket(self, position: int, value: int) -> Tuple[int, int]:
+        """ Range of rows in copy position whose argument at position is value. """
+        column = self.columns[position]
+        return bisect_left(column, value), bisect_right(column, value)
+
+    def candidates(self, proposal: cog.Proposal):
+        """ Argument tuples that might satisfy the proposal, from the smallest bucket
+        among its fixed arguments.
+        """
+        if not proposal.fixed_arguments:
+            yield from self
+            return
+        if len(proposal.encoded) != self.arity:
+            return
+
+        best = None
+        for position in proposal.fixed_arguments:
+            low, high = self.bucket(position, proposal.encoded[position])
+            if best is None or high - low < best[2] - best[1]:
+                best = (position, low, high)
+                if low == high:
+                    return
+
+        yield from self.rows_between(*best)
+
+    def rows_between(self, position: int, low: int, high: int):
+        """ Rows low to high of the copy sorted on position, as tuples. """
+        rows = self.rows[position]
+        arity = self.arity
+        for row in range(low, high):
+            yield tuple(rows[row*arity:(row+1)*arity])
+
+
+class ClosedRelations:
+    """ The facts of a closed SharedStaticKnowledge. Reading them is an error rather than
+    an empty world, which would quietly make every plan fail.
+    """
+    def _closed(self, *args):
+        raise ValueError("shared static knowledge is closed")
+
+    get = __getitem__ = __contains__ = __iter__ = __len__ = items = values = _closed
+
+
+CLOSED = ClosedRelations()
+
+
+class SharedStaticKnowledge:
+    """ Static facts packed into a multiprocessing.shared_memory block, as int32 rows.
+    Stands in for the static BaseKnowledge of a KnowledgeStack, read only.
+    Pickling it sends only the name of the block and where each functor lives in it,
+    so worker processes attach to the same memory instead of receiving a copy of the world.
+
+    The process that creates it owns the block: close() and unlink() it when done,
+    or use it as a context manager. Once closed, reading it raises ValueError.
+    """
+    def __init__(self, block: shared_memory.SharedMemory, layout: dict, owner: bool):
+        self.block = block
+        # functor -> (offset in bytes, arity, count)
+        self.layout = layout
+        self.owner = owner
+        # (weak reference to the stack, its static store and static_shared) that 
+        # share_static replaced with this, put back on close
+        self.replaced = None
+
+        ints = block.buf.cast('i')
+        self.ints = ints
+        self.facts = {}
+        for functor, (offset, arity, count) in layout.items():
+            start = offset // ints.itemsize
+            self.facts[functor] = SharedRelation(ints[start:start + arity*arity*count], arity, count)
+
+    @staticmethod
+    def create(static: cog.BaseKnowledge) -> 'SharedStaticKnowledge':
+        """ Pack a static store into a new shared memory block. """
+        packed = array('i')
+        layout = {}
+        for functor, facts in static.facts.items():
+            if not facts:
+                continue
+            arity = len(next(iter(facts)))
+            layout[functor] = (len(packed) * packed.itemsize, arity, len(facts))
+            for position in range(arity):
+                for row in sorted(facts, key=lambda arguments: (arguments[position], arguments)):
+                    packed.extend(row)
+
+        # a block can't be empty
+        block = shared_memory.SharedMemory(create=True, size=max(1, len(packed) * packed.itemsize))
+        block.buf[:len(packed) * packed.itemsize] = packed.tobytes()
+        return SharedStaticKnowledge(block, layout, owner=True)
+
+    @staticmethod
+    def attach(name: str, layout: dict) -> 'SharedStaticKnowledge':
+        # Only the creator should destroy the block. Before python 3.13 attaching always
+        # registers it with the resource tracker, which is harmless for pool workers:
+        # they share the tracker of the process that started them, creator included.
+        try:
+            block = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            block = shared_memory.SharedMemory(name=name)
+        return SharedStaticKnowledge(block, layout, owner=False)
+
+    def __reduce__(self):
+        return (SharedStaticKnowledge.attach, (self.block.name, self.layout))
+
+    def __deepcopy__(self, memo):
+        # read only, so every copy of a stack can keep pointing at the same block
+        return self
+
+    def append(self, fact: cog.Fact) -> None:
+        raise ValueError(f"shared static knowledge is read only, cannot add {fact}")
+
+    def test(self, fact: cog.Fact) -> bool:
+        return fact.encoded in self.facts.get(fact.functor, cog.NO_FACTS)
+
+    def candidates(self, proposal: cog.Proposal):
+        try:
+            return self.facts[proposal.functor].candidates(proposal)
+        except KeyError:
+            return cog.NO_FACTS
+
+    def count(self, proposal: cog.Proposal) -> int:
+        """ Size of the smallest bucket among the proposal's fixed arguments. """
+        try:
+            relation = self.facts[proposal.functor]
+        except KeyError:
+            return 0
+        if not proposal.fixed_arguments:
+            return len(relation)
+        if len(proposal.encoded) != relation.arity:
+            return 0
+        best = len(relation)
+        for position in proposal.fixed_arguments:
+            low, high = relation.bucket(position, proposal.encoded[position])
+            best = min(best, high - low)
+        return best
+
+    def lookup(self, functor, position: int, value: int):
+        try:
+            relation = self.facts[functor]
+        except KeyError:
+            return cog.NO_FACTS
+        if position >= relation.arity:
+            return cog.NO_FACTS
+        low, high = relation.bucket(position, value)
+        return relation.rows_between(position, low, high)
+
+    def find_possible_solutions(self, proposal) -> None:
+        for fact_arguments in self.candidates(proposal):
+            proposal.consider(fact_arguments)
+
+    def close(self) -> None:
+        """ Detach from the block. Every view into it has to go first. """
+        if self.ints is None:
+            return
+        for relation in self.facts.values():
+            for rows in relation.rows:
+                rows.release()
+            for column in relation.columns:
+                column.release()
+        self.facts = CLOSED
+        self.ints.release()
+        self.ints = None
+        self.block.close()
+
+        if self.replaced is not None:
+            knowledge, static, static_shared = self.replaced
+            knowledge = knowledge()
+            if knowledge is not None and knowledge.static is self:
+                knowledge.static = static
+                knowledge.static_shared = static_shared
+            self.replaced = None
+
+    def __del__(self):
+        # before the block's own finalizer, which can't close while our views are alive
+        self.close()
+
+    def unlink(self) -> None:
+        """ Free the block, once every process is done with it. """
+        self.block.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        if self.owner:
+            self.unlink()
+
+
+def share_static(knowledge: cog.KnowledgeStack) -> SharedStaticKnowledge:
+    """ Move the static facts of knowledge into shared memory. knowledge and the snapshots
+    taken from it from now on read them from there, and so does anything it is pickled to,
+    eg the workers of parallel.plan_batch. Static facts can no longer be added.
+    Closing the shared store gives knowledge its own static store back. Snapshots taken
+    in the meantime keep the shared one, and can't be read once it's closed.
+    """
+    shared = SharedStaticKnowledge.create(knowledge.static)
+    shared.replaced = (weakref.ref(knowledge), knowledge.static, knowledge.static_shared)
+    knowledge.static = shared
+    knowledge.static_shared = True
+    return shared
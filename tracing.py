@@ -0,0 +1,135 @@
+import json
+import os
+import time
+
+
+class ChromeTracer:
+    """ Writes Chrome trace events (chrome://tracing, ui.perfetto.dev) as they happen,
+    so a long search isn't held in memory. Hand one to SearchPlan as tracer.
+
+    Each SearchPlan gets a track for its expansions and heuristic evaluations, and one
+    for EHC plateaus. Open list size and best heuristic are counters.
+    The file is a JSON array of events. The viewers accept it without its closing
+    bracket, so the trace of a search that crashed can still be read.
+    """
+    def __init__(self, path: str, process_name: str='cognate'):
+        self.file = open(path, 'w')
+        self.pid = os.getpid()
+        self.start_ns = time.perf_counter_ns()
+        self.tracks = 0
+        self.first = True
+
+        self.file.write("[\n")
+        self._write({"name": "process_name", "ph": "M", "pid": self.pid, "tid": 0,
+                     "args": {"name": process_name}})
+
+    def now(self) -> float:
+        """ Microseconds since the tracer started, the unit of the trace. """
+        return (time.perf_counter_ns() - self.start_ns) / 1000
+
+    def track(self, name: str) -> int:
+        """ A new named row in the viewer. Returns its id, the tid of events on it. """
+        self.tracks += 1
+        self._write({"name": "thread_name", "ph": "M", "pid": self.pid, "tid": self.tracks,
+                     "args": {"name": name}})
+        self._write({"name": "thread_sort_index", "ph": "M", "pid": self.pid, "tid": self.tracks,
+                     "args": {"sort_index": self.tracks}})
+        return self.tracks
+
+    def complete(self, name: str, track: int, start: float, args: dict=None, category: str='search') -> None:
+        """ A span from start, as given by now(), to now. Spans on a track must nest. """
+        event = {"name": name, "cat": category, "ph": "X", "ts": start, "dur": self.now() - start,
+                 "pid": self.pid, "tid": track}
+        if args:
+            event["args"] = args
+        self._write(event)
+
+    def instant(self, name: str, track: int, args: dict=None, category: str='search') -> None:
+        event = {"name": name, "cat": category, "ph": "i", "s": "t", "ts": self.now(),
+                 "pid": self.pid, "tid": track}
+        if args:
+            event["args"] = args
+        self._write(event)
+
+    def counter(self, name: str, values: dict) -> None:
+        """ Values of a counter from now on, eg counter('open list', {'states': 12}). """
+        self._write({"name": name, "ph": "C", "ts": self.now(), "pid": self.pid, "args": values})
+
+    def _write(self, event: dict) -> None:
+        if not self.first:
+            self.file.write(",\n")
+        self.first = False
+        self.file.write(json.dumps(event))
+
+    def close(self) -> None:
+        if self.file is None:
+            return
+        self.file.write("\n]\n")
+        self.file.close()
+        self.file = None
+
+    def __enter__(self) -> 'ChromeTracer':
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class SearchTrace:
+    """ What one SearchPlan writes to a tracer: its tracks, and the plateau EHC is on. """
+    def __init__(self, tracer: ChromeTracer, name: str):
+        self.tracer = tracer
+        self.name = name
+        self.search = tracer.track(f"{name} search")
+        self.plateaus = tracer.track(f"{name} EHC plateaus")
+
+        # when the current plateau began, and how many states it has expanded
+        self.plateau_start = None
+        self.plateau_heuristic = None
+        self.plateau_expansions = 0
+
+    def expanded(self, state, start: float, successors: int, open_list: int, best_heuristic: int) -> None:
+        tracer = self.tracer
+        tracer.complete("expand", self.search, start, {
+            "depth": state.depth,
+            "heuristic": state.heuristic,
+            "action": str(state.action),
+            "state": f"{state.fingerprint & 0xFFFFFFFFFFFFFFFF:016x}",
+            "successors": successors,
+        })
+        tracer.counter(f"{self.name} open list", {"states": open_list})
+        tracer.counter(f"{self.name} best heuristic", {"heuristic": best_heuristic})
+
+    def evaluated(self, state, start: float, heuristic: int, helpful: int) -> None:
+        self.tracer.complete("heuristic", self.search, start, {
+            "depth": state.depth,
+            "heuristic": heuristic,
+            "helpful actions": helpful,
+        }, category='heuristic')
+
+    def on_plateau(self, heuristic: int) -> None:
+        """ EHC expanded a state without finding a better one: it is searching breadth first
+        for a way off the plateau. Called after each such expansion.
+        """
+        if self.plateau_start is None:
+            self.plateau_start = self.tracer.now()
+            self.plateau_heuristic = heuristic
+            self.plateau_expansions = 0
+        self.plateau_expansions += 1
+
+    def improved(self, heuristic: int) -> None:
+        """ EHC found a better state, which ends any plateau. """
+        if self.plateau_start is not None:
+            self.end_plateau("escaped", heuristic)
+        self.tracer.instant("improvement", self.search, {"heuristic": heuristic})
+
+    def end_plateau(self, outcome: str, heuristic: int=None) -> None:
+        if self.plateau_start is None:
+            return
+        self.tracer.complete("plateau", self.plateaus, self.plateau_start, {
+            "heuristic": self.plateau_heuristic,
+            "expansions": self.plateau_expansions,
+            "outcome": outcome,
+            "escaped to": heuristic,
+        })
+        self.plateau_start = None
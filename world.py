@@ -45,7 +45,7 @@ class Edge:
     def set_index(self, index: int) -> None:
         self.index = index
 
-    def make_gate(self, open: bool, trigger_location: str) -> None
+    def make_gate(self, open: bool, trigger_location: str) -> None:
         self.gate_open = open
         self.trigger_location = trigger_location
 